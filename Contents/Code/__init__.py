@@ -19,33 +19,128 @@ CREDITS:
     Subtitle support and some fixes: glitch452
 """
 
-from datetime import datetime
+import time
+
+IMPORT_START = time.time()
+
+import functools
 import os
 import re
 import sys
-from dateutil.parser import parse
-
-if sys.version_info < (3, 0):
-    from htmlentitydefs import name2codepoint
-else:
-    from html.entities import name2codepoint
+import threading
 
+if sys.version_info >= (3, 0):
     unichr = chr  # chr is already unicode
 
 # PLEX API
 preferences = Prefs
 element_from_string = XML.ElementFromString
 load_file = Core.storage.load
+persistent_dict = Dict
+create_thread = Thread.Create
+data_path = Core.storage.data_path
 PlexAgent = Agent.Movies
 MediaProxy = Proxy.Media
 Metadata = MetadataSearchResult
 Trailer = TrailerObject
+Featurette = FeaturetteObject
+plugin_handler = handler
+plugin_route = route
+json_from_object = JSON.StringFromObject
+
+
+class LazyRegex(object):
+    """
+    A regular expression that is compiled on first use.
+
+    Keeps the compilation of rarely used expressions out of the plugin's
+    startup.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self._regex = None
+
+    def compile(self):
+        if self._regex is None:
+            self._regex = re.compile(self.pattern, self.flags)
+        return self._regex
+
+    def __getattr__(self, name):
+        return getattr(self.compile(), name)
 
 
-NFO_TEXT_REGEX_1 = re.compile(r"&(?![A-Za-z]+[0-9]*;|#[0-9]+;|#x[0-9a-fA-F]+;)")
-NFO_TEXT_REGEX_2 = re.compile(r"^\s*<.*/>[\r\n]+", flags=re.MULTILINE)
-RATING_REGEX_1 = re.compile(r"(?:Rated\s)?(?P<mpaa>[A-z0-9-+/.]+(?:\s[0-9]+[A-z]?)?)?")
-RATING_REGEX_2 = re.compile(r"\s*\(.*?\)")
+NFO_TEXT_REGEX_1 = LazyRegex(r"&(?![A-Za-z]+[0-9]*;|#[0-9]+;|#x[0-9a-fA-F]+;)")
+NFO_TEXT_REGEX_2 = LazyRegex(r"^\s*<.*/>[\r\n]+", flags=re.MULTILINE)
+RATING_REGEX_1 = LazyRegex(r"(?:Rated\s)?(?P<mpaa>[A-z0-9-+/.]+(?:\s[0-9]+[A-z]?)?)?")
+RATING_REGEX_2 = LazyRegex(r"\s*\(.*?\)")
+DURATION_REGEX = LazyRegex(r"^([0-9]+)")
+# Removes 'Series' and 'Collection' from the end of set names
+# since Plex adds 'Collection' in the GUI already
+SET_NAME_REGEX = LazyRegex(r"[\s]?(series|collection)$", re.IGNORECASE)
+
+
+def instrumented(phase, get_title):
+    """
+    Decorate an agent entry point with the opt-in instrumentation, the
+    memory accounting and the call profiler.
+
+    :param phase: name of the phase recorded for the calls
+    :param get_title: callable returning the title a call works on, given
+        the call's positional arguments
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not instrumentation_used():
+                return function(*args, **kwargs)
+            from memory import memory_tracker
+            from profiler import call_profiler
+
+            try:
+                title = get_title(args)
+            except Exception:
+                title = None
+            return call_profiler.call(
+                phase, memory_tracker.call, phase, title, function, *args, **kwargs
+            )
+
+        return wrapper
+
+    return decorator
+
+
+# Preferences that turn on the memory accounting and the call profiler.
+INSTRUMENTATION_PREFS = ("memprofile", "profile")
+instrumentation_imported = False
+
+
+def instrumentation_used():
+    """
+    Check whether calls go through the memory accounting and the call
+    profiler.
+
+    Both are imported once a preference turns them on and stay in use
+    afterwards, e.g. to stop tracing when the preference is turned off.
+    """
+    global instrumentation_imported
+    if not instrumentation_imported:
+        for name in INSTRUMENTATION_PREFS:
+            try:
+                if preferences[name]:
+                    instrumentation_imported = True
+            except KeyError:
+                pass
+    return instrumentation_imported
+
+
+def media_file(args):
+    """
+    Get the media file of a search or update call from its arguments.
+    """
+    return args[2].items[0].parts[0].file
 
 
 def first(iterable, default=None):
@@ -69,6 +164,195 @@ class NFOReader:
                 set_list.append(name_el.text)
         return set_list
 
+    def read_record(self):
+        """
+        core fields into a dict than return it, None if there is no title.
+
+        Duration and roles are left to read_duration and read_roles.
+        """
+        nfo_xml = self.nfo_xml
+        record = {}
+        # Title
+        try:
+            record["title"] = nfo_xml.xpath("title")[0].text.strip()
+        except:
+            return None
+        # Sort Title
+        try:
+            record["title_sort"] = nfo_xml.xpath("sorttitle")[0].text.strip()
+        except:
+            log.debug("No <sorttitle> tag in nfo.")
+            pass
+        # Year
+        try:
+            record["year"] = int(nfo_xml.xpath("year")[0].text.strip())
+            log.debug("Reading year tag: {year}".format(year=record["year"]))
+        except:
+            pass
+        # Ratings
+        nfo_rating = None
+        try:
+            nfo_rating = round(
+                float(nfo_xml.xpath("rating")[0].text.replace(",", ".")), 1
+            )
+            log.debug("Movie Rating found: " + str(nfo_rating))
+        except:
+            pass
+        if not nfo_rating:
+            for ratings in nfo_xml.xpath("ratings"):
+                try:
+                    rating = ratings.xpath("rating")[0]
+                    nfo_rating = round(
+                        float(rating.xpath("value")[0].text.replace(",", ".")),
+                        1,
+                    )
+                except:
+                    log.debug("Can't read rating from .nfo.")
+                    nfo_rating = 0.0
+                    pass
+        record["rating"] = nfo_rating
+        # Tagline
+        try:
+            record["tagline"] = nfo_xml.xpath("tagline")[0].text.strip()
+        except:
+            pass
+        # Summary (Outline/Plot)
+        record["summary"] = ""
+        try:
+            record["summary"] = nfo_xml.xpath("plot")[0].text.strip()
+        except:
+            log.debug("Exception on reading summary!")
+            pass
+        # Original Title
+        try:
+            record["original_title"] = nfo_xml.xpath("originaltitle")[0].text.strip()
+        except:
+            pass
+        # Content Rating
+        record["content_rating"] = ""
+        try:
+            mpaa_text = nfo_xml.xpath("./mpaa")[0].text.strip()
+            match = RATING_REGEX_1.match(mpaa_text)
+            if match.group("mpaa"):
+                mpaa_rating = match.group("mpaa")
+                conuntry_rating = mpaa_rating.split("-", 1)
+                if "ES" in mpaa_rating:
+                    mpaa_rating = ("es/") + conuntry_rating[1]
+                else:
+                    mpaa_rating = ("us/") + mpaa_rating
+                log.debug("MPAA Rating: " + mpaa_rating)
+                record["content_rating"] = mpaa_rating
+            else:
+                record["content_rating"] = "NR"
+        except:
+            pass
+        # Studio
+        try:
+            record["studio"] = nfo_xml.xpath("studio")[0].text.strip()
+        except:
+            pass
+        # Premiere
+        try:
+            log.debug("Reading releasedate tag...")
+            record["release_date"] = nfo_xml.xpath("releasedate")[0].text.strip()
+        except:
+            log.debug("No releasedate tag found...")
+            try:
+                log.debug("Reading premiered tag...")
+                record["release_date"] = nfo_xml.xpath("premiered")[0].text.strip()
+            except:
+                log.debug("No premiered tag found...")
+                pass
+        # Writers (Credits), Directors, Genres, Countries
+        for key, tag in (
+            ("writers", "credits"),
+            ("directors", "director"),
+            ("genres", "genre"),
+            ("countries", "country"),
+        ):
+            record[key] = []
+            try:
+                for element in nfo_xml.xpath(tag):
+                    record[key].extend(
+                        [i.strip() for i in element.text.split("/") if i.strip()]
+                    )
+            except:
+                pass
+        # Collections (Set)
+        record["collections"] = []
+        try:
+            for setname in self.read_sets_name():
+                setname = SET_NAME_REGEX.sub("", setname.strip())
+                if setname:  # skip empty name
+                    log.debug("Set name found: " + setname)
+                    record["collections"].append(setname)
+                else:
+                    log.debug("No set name found...")
+        except Exception as e:
+            log.error("Raised error when parsing set: {}".format(e))
+        return record
+
+    def read_duration(self):
+        """
+        duration in milliseconds, None if there is none.
+        """
+        try:
+            log.debug("Trying to read <durationinseconds> tag from .nfo file...")
+            file_info_xml = self.nfo_xml.xpath("fileinfo")[0]
+            stream_details_xml = file_info_xml.xpath("streamdetails")[0]
+            video_xml = stream_details_xml.xpath("video")[0]
+            runtime = video_xml.xpath("durationinseconds")[0].text.strip()
+            return int(DURATION_REGEX.findall(runtime)[0]) * 1000  # s
+        except:
+            try:
+                log.debug("Fallback to <runtime> tag from .nfo file...")
+                runtime = self.nfo_xml.xpath("runtime")[0].text.strip()
+                return int(DURATION_REGEX.findall(runtime)[0]) * 60 * 1000  # ms
+            except:
+                log.debug("No Duration in .nfo file.")
+                return None
+
+    def read_roles(self, limit=0):
+        """
+        actors into a list of (name, role, photo) tuples than return it.
+
+        Actors are sorted by their <order>, actors without one follow in the
+        order of the nfo. Every actor is read in a single pass over its
+        children and duplicate roles are found with a set.
+
+        :param limit: maximum number of actors, 0 for no limit
+        """
+        actors = []
+        for n, actor in enumerate(self.nfo_xml.xpath("actor")):
+            fields = {}
+            for child in actor:
+                fields.setdefault(child.tag, child.text)
+            try:
+                order = int(fields["order"].strip())
+            except (KeyError, AttributeError, ValueError):
+                order = None
+            actors.append((order is None, order or 0, n, fields))
+        actors.sort(key=lambda actor: actor[:3])
+        total = len(actors)
+        if limit:
+            actors = actors[:limit]
+
+        roles = []
+        seen_roles = set()
+        for _, _, n, fields in actors:
+            name = fields.get("name") or "Unknown Name " + str(n)
+            role = fields.get("role")
+            if not role:
+                role = "Unknown Role " + str(n)
+            elif role in seen_roles:
+                role = role + " " + str(n)
+            seen_roles.add(role)
+            roles.append((name, role, fields.get("thumb") or ""))
+        log.debug(
+            "Read {number} of {total} actors".format(number=len(roles), total=total)
+        )
+        return roles
+
 
 class XBMCNFO(PlexAgent):
     """
@@ -84,6 +368,7 @@ class XBMCNFO(PlexAgent):
     accepts_from = ["com.plexapp.agents.localmedia"]
 
     # ##### search function #####
+    @instrumented("search", media_file)
     def search(self, results, media, lang):
         log.debug("++++++++++++++++++++++++")
         log.debug("Entering search function")
@@ -100,133 +385,81 @@ class XBMCNFO(PlexAgent):
         path1 = media.items[0].parts[0].file
         log.debug("media file: {name}".format(name=path1))
 
-        folder_path = os.path.dirname(path1)
-        log.debug("folder path: {name}".format(name=folder_path))
-
-        # Movie name with year from folder
-        movie_name_with_year = get_movie_name_from_folder(folder_path, True)
-        # Movie name from folder
-        movie_name = get_movie_name_from_folder(folder_path, False)
-
-        nfo_names = get_related_files(path1, ".nfo")
-        nfo_names.extend(
-            [
-                # moviename.nfo
-                "{movie}.nfo".format(movie=movie_name_with_year),
-                "{movie}.nfo".format(movie=movie_name),
-                # movie.nfo
-                os.path.join(folder_path, "movie.nfo"),
-            ]
-        )
-
-        # last resort - use first found .nfo
-        nfo_files = (f for f in os.listdir(folder_path) if f.endswith(".nfo"))
-
-        try:
-            first_nfo = nfo_files.next()
-        except StopIteration:
-            log.debug("No NFO found in {path!r}".format(path=folder_path))
-        else:
-            nfo_names.append(os.path.join(folder_path, first_nfo))
+        plan = get_path_plan(path1)
+        log.debug("folder path: {name}".format(name=plan.folder_path))
 
         # check possible .nfo file locations
-        nfo_file = check_file_paths(nfo_names, ".nfo")
+        nfo_file = resolve_file(
+            plan.library_root,
+            "nfo",
+            plan.search_nfo,
+            ".nfo",
+            folder_path=plan.title_root,
+        )
 
-        if nfo_file:
-            nfo_text = load_file(nfo_file)
-            # work around failing XML parses for things with &'s in
-            # them. This may need to go farther than just &'s....
-            nfo_text = NFO_TEXT_REGEX_1.sub("&amp;", nfo_text)
-            # remove empty xml tags from nfo
-            log.debug("Removing empty XML tags from movies nfo...")
-            nfo_text = NFO_TEXT_REGEX_2.sub("", nfo_text)
-
-            nfo_text_lower = nfo_text.lower()
-            if (
-                nfo_text_lower.count("<movie") > 0
-                and nfo_text_lower.count("</movie>") > 0
-            ):
-                # Remove URLs (or other stuff) at the end of the XML file
-                nfo_text = "{content}</movie>".format(
-                    content=nfo_text.rsplit("</movie>", 1)[0]
-                )
+        if not nfo_file:
+            return
 
-                # likely an xbmc nfo file
-                try:
-                    nfo_xml = element_from_string(nfo_text).xpath("//movie")[0]
-                except:
-                    log.debug(
-                        "ERROR: Cant parse XML in {nfo}."
-                        " Aborting!".format(nfo=nfo_file)
-                    )
-                    return
+        identity = read_identity(nfo_file)
+        if identity is None:
+            return
 
-                # Title
-                try:
-                    media.name = nfo_xml.xpath("title")[0].text
-                except:
-                    log.debug(
-                        "ERROR: No <title> tag in {nfo}."
-                        " Aborting!".format(nfo=nfo_file)
-                    )
-                    return
-                # Sort Title
-                try:
-                    media.title_sort = nfo_xml.xpath("sorttitle")[0].text
-                except:
-                    log.debug("No <sorttitle> tag in {nfo}.".format(nfo=nfo_file))
-                    pass
-                # Year
-                try:
-                    media.year = int(nfo_xml.xpath("year")[0].text.strip())
-                    log.debug("Reading year tag: {year}".format(year=media.year))
-                except:
-                    pass
-                # ID
-                try:
-                    id = nfo_xml.xpath("tmdbid")[0].text.strip()
-                except:
-                    id = ""
-                    pass
-                if len(id) > 2:
-                    media.id = id
-                    log.debug("ID from nfo: {id}".format(id=media.id))
-                else:
-                    # if movie id doesn't exist, create
-                    # one based on hash of title and year
-                    def ord3(x):
-                        return "%.3d" % ord(x)
-
-                    id = int("".join(map(ord3, media.name + str(media.year))))
-                    id = str(abs(hash(int(id))))
-                    media.id = id
-                    log.debug("ID generated: {id}".format(id=media.id))
-
-                results.Append(
-                    Metadata(
-                        id=media.id,
-                        name=media.name,
-                        year=media.year,
-                        lang=lang,
-                        score=100,
-                    )
-                )
-                try:
-                    log.info(
-                        "Found movie information in NFO file:"
-                        " title = {nfo.name},"
-                        " year = {nfo.year},"
-                        " id = {nfo.id}".format(nfo=media)
-                    )
-                except:
-                    pass
-            else:
-                log.info(
-                    "ERROR: No <movie> tag in {nfo}. Aborting!".format(nfo=nfo_file)
-                )
+        # Title
+        if not identity.get("title"):
+            log.debug(
+                "ERROR: No <title> tag in {nfo}." " Aborting!".format(nfo=nfo_file)
+            )
+            return
+        media.name = identity["title"]
+        # Sort Title
+        if "sorttitle" in identity:
+            media.title_sort = identity["sorttitle"]
+        else:
+            log.debug("No <sorttitle> tag in {nfo}.".format(nfo=nfo_file))
+        # Year
+        try:
+            media.year = int(identity["year"].strip())
+            log.debug("Reading year tag: {year}".format(year=media.year))
+        except (KeyError, ValueError):
+            pass
+        # ID
+        id = identity.get("tmdbid", "").strip()
+        if len(id) > 2:
+            media.id = id
+            log.debug("ID from nfo: {id}".format(id=media.id))
+        else:
+            # if movie id doesn't exist, create
+            # one based on hash of title and year
+            def ord3(x):
+                return "%.3d" % ord(x)
+
+            id = int("".join(map(ord3, media.name + str(media.year))))
+            id = str(abs(hash(int(id))))
+            media.id = id
+            log.debug("ID generated: {id}".format(id=media.id))
+
+        results.Append(
+            Metadata(
+                id=media.id,
+                name=media.name,
+                year=media.year,
+                lang=lang,
+                score=100,
+            )
+        )
+        try:
+            log.info(
+                "Found movie information in NFO file:"
+                " title = {nfo.name},"
+                " year = {nfo.year},"
+                " id = {nfo.id}".format(nfo=media)
+            )
+        except:
+            pass
 
     # ##### update Function #####
 
+    @instrumented("update", media_file)
     def update(self, metadata, media, lang):
         log.debug("++++++++++++++++++++++++")
         log.debug("Entering update function")
@@ -240,442 +473,249 @@ class XBMCNFO(PlexAgent):
         else:
             log.info("Agents debug logging is disabled!")
 
-        poster_data = None
-        poster_filename = None
-        fanart_data = None
-        fanart_filename = None
+        # artwork, actors, durations and subtitles are deferred
+        # once the time budget of this title is used up
+        deadline = Deadline(get_update_budget())
 
         path1 = media.items[0].parts[0].file
         log.debug("media file: {name}".format(name=path1))
 
-        folder_path = os.path.dirname(path1)
-        log.debug("folder path: {name}".format(name=folder_path))
-
-        is_dvd = os.path.basename(folder_path).upper() == "VIDEO_TS"
-        folder_path_dvd = os.path.dirname(folder_path) if is_dvd else None
+        plan = get_path_plan(path1)
+        log.debug("folder path: {name}".format(name=plan.folder_path))
+
+        # within the freshness window the files found by the last update are
+        # served without checking them, they are checked in the background
+        record = None
+        fresh = fresh_results.lookup(path1)
+        if fresh is not None:
+            nfo_file = fresh.nfo_file
+            poster_filename = fresh.poster
+            fanart_filename = fresh.fanart
+            if nfo_file:
+                record = nfo_aliases.get(nfo_file, fresh.nfo_stat)
+            if nfo_file and record is None:
+                fresh = None
+            else:
+                log.debug(
+                    "Serving files checked {age:.0f}s ago".format(
+                        age=time.time() - fresh.validated
+                    )
+                )
+                fresh_results.serve(path1, revalidate_title)
+        if fresh is None:
+            nfo_file, poster_filename, fanart_filename = resolve_title_files(plan)
+
+        # core fields are applied before any of the heavy stages
+        nfo_reader = None
+        if nfo_file and record is None:
+            record = nfo_aliases.get(nfo_file)
+            if record is None:
+                record = get_record_snapshot().lookup(nfo_file)
+                if record is not None:
+                    nfo_aliases.put(nfo_file, record)
+        if fresh is None:
+            # let the disk fetch the files of the title in one sweep, skipping
+            # the ones served from the caches
+            prefetch(
+                [nfo_file if record is None else None]
+                + [
+                    artwork
+                    for artwork in (poster_filename, fanart_filename)
+                    if artwork and not artwork_aliases.contains(artwork)
+                ]
+            )
+        if nfo_file:
+            if record is None:
+                nfo_xml = read_nfo(nfo_file)
+                if nfo_xml is not None:
+                    nfo_reader = NFOReader(nfo_xml)
+                    record = nfo_reader.read_record()
+                    if record is None:
+                        log.debug(
+                            "ERROR: No <title> tag in {nfo}."
+                            " Aborting!".format(nfo=nfo_file)
+                        )
+            if record is not None:
+                apply_record(metadata, record)
+
+        # artwork served from the freshness window is kept when it is attached
+        if poster_filename and not (
+            fresh and poster_filename in metadata.posters.keys()
+        ):
+            run_stage(
+                deadline,
+                "poster",
+                poster_filename,
+                load_artwork,
+                lambda data: set_artwork(metadata.posters, poster_filename, data),
+                poster_filename,
+            )
 
-        # Movie name with year from folder
-        movie_name_with_year = get_movie_name_from_folder(folder_path, True)
+        if fanart_filename and not (fresh and fanart_filename in metadata.art.keys()):
+            run_stage(
+                deadline,
+                "fanart",
+                fanart_filename,
+                load_artwork,
+                lambda data: set_artwork(metadata.art, fanart_filename, data),
+                fanart_filename,
+            )
 
-        # Movie name from folder
-        movie_name = get_movie_name_from_folder(folder_path, False)
+        # Subtitles
+        if preferences["subtitle"] and not preferences["localmediaagent"]:
+            for item in media.items:
+                for part in item.parts:
+                    run_stage(
+                        deadline,
+                        "subtitles",
+                        part.file,
+                        find_subtitle_files,
+                        lambda subtitle_files, part=part: set_subtitles(
+                            part, subtitle_files
+                        ),
+                        part.file,
+                    )
 
-        # if not preferences["localmediaagent"]:
-        poster_names = get_related_files(path1, "-poster.jpg")
-        poster_names.extend(
-            [
-                # Frodo
-                "{movie}-poster.jpg".format(movie=movie_name_with_year),
-                "{movie}-poster.jpg".format(movie=movie_name),
-                os.path.join(folder_path, "poster.jpg"),
-            ]
-        )
-        extend_file_name(poster_names)
-        # check possible poster file locations
-        poster_filename = check_file_paths(poster_names, "poster")
-
-        if poster_filename:
-            poster_data = load_file(poster_filename)
-            for key in metadata.posters.keys():
-                del metadata.posters[key]
-            metadata.posters[poster_filename] = MediaProxy(poster_data)
-
-        fanart_names = get_related_files(path1, "-fanart.jpg")
-        fanart_names.extend(
-            [
-                # Eden / Frodo
-                "{movie}-fanart.jpg".format(movie=movie_name_with_year),
-                "{movie}-fanart.jpg".format(movie=movie_name),
-                os.path.join(folder_path, "fanart.jpg"),
-            ]
-        )
-        extend_file_name(fanart_names)
-        # check possible fanart file locations
-        fanart_filename = check_file_paths(fanart_names, "fanart")
-
-        if fanart_filename:
-            fanart_data = load_file(fanart_filename)
-            for key in metadata.art.keys():
-                del metadata.art[key]
-            metadata.art[fanart_filename] = MediaProxy(fanart_data)
-
-        nfo_names = get_related_files(path1, ".nfo")
-        nfo_names.extend(
-            [
-                "{movie}.nfo".format(movie=movie_name_with_year),
-                "{movie}.nfo".format(movie=movie_name),
-            ]
-        )
+        # Local trailers and extras
+        if preferences["trailer"] and not preferences["localmediaagent"]:
+            run_stage(
+                deadline,
+                "extras",
+                plan.title_root,
+                find_local_extras,
+                lambda extras: set_extras(metadata, extras),
+                plan,
+            )
 
-        # last resort - use first found .nfo
-        nfo_files = (f for f in os.listdir(folder_path) if f.endswith(".nfo"))
+        if record is None:
+            return
 
-        try:
-            first_nfo = nfo_files.next()
-        except StopIteration:
-            log.debug("No NFO file found in {path!r}".format(path=folder_path))
+        if nfo_reader is None:
+            # records from the caches are complete
+            set_duration(metadata, record.get("duration"))
+            set_roles(metadata, record.get("roles", []), get_max_actors())
         else:
-            nfo_names.append(os.path.join(folder_path, first_nfo))
-
-        # check possible .nfo file locations
-        nfo_file = check_file_paths(nfo_names, ".nfo")
 
-        if nfo_file:
-            nfo_text = load_file(nfo_file)
+            def apply_duration(duration):
+                set_duration(metadata, duration)
+                record["duration"] = duration
 
-            # work around failing XML parses for things with &'s in
-            # them. This may need to go farther than just &'s....
-            nfo_text = NFO_TEXT_REGEX_1.sub(r"&amp;", nfo_text)
+            # records keep all roles, so a changed maxactors preference
+            # applies to cached records as well
+            def apply_roles(roles):
+                set_roles(metadata, roles, get_max_actors())
+                record["roles"] = roles
 
-            # remove empty xml tags from nfo
-            log.debug("Removing empty XML tags from movies nfo...")
-            nfo_text = NFO_TEXT_REGEX_2.sub("", nfo_text)
-
-            nfo_text_lower = nfo_text.lower()
-
-            if (
-                nfo_text_lower.count("<movie") > 0
-                and nfo_text_lower.count("</movie>") > 0
-            ):
-                # Remove URLs (or other stuff) at the end of the XML file
-                nfo_text = "{content}</movie>".format(
-                    content=nfo_text.rsplit("</movie>", 1)[0]
-                )
-
-                # likely an xbmc nfo file
-                try:
-                    nfo_xml = element_from_string(nfo_text).xpath("//movie")[0]
-                except:
-                    log.debug(
-                        "ERROR: Cant parse XML in {nfo}."
-                        " Aborting!".format(nfo=nfo_file)
-                    )
-                    return
-
-                nfo_reader = NFOReader(nfo_xml)
+            # Duration
+            run_stage(
+                deadline, "duration", nfo_file, nfo_reader.read_duration, apply_duration
+            )
+            # Actors
+            run_stage(
+                deadline,
+                "roles",
+                nfo_file,
+                nfo_reader.read_roles,
+                apply_roles,
+            )
 
-                # remove empty xml tags
-                log.debug("Removing empty XML tags from movies nfo...")
-                nfo_xml = remove_empty_tags(nfo_xml)
+            if "duration" in record and "roles" in record:
+                nfo_aliases.put(nfo_file, record)
+                get_record_snapshot().add(nfo_file, record)
 
-                # Title
-                try:
-                    metadata.title = nfo_xml.xpath("title")[0].text.strip()
-                except:
-                    log.debug(
-                        "ERROR: No <title> tag in {nfo}."
-                        " Aborting!".format(nfo=nfo_file)
-                    )
-                    return
-                # Sort Title
-                try:
-                    metadata.title_sort = nfo_xml.xpath("sorttitle")[0].text.strip()
-                except:
-                    log.debug("No <sorttitle> tag in {nfo}.".format(nfo=nfo_file))
-                    pass
-                # Year
-                try:
-                    metadata.year = int(nfo_xml.xpath("year")[0].text.strip())
-                    log.debug("Set year tag: {year}".format(year=metadata.year))
-                except:
-                    pass
-                # Original Title
-                try:
-                    metadata.original_title = nfo_xml.xpath("originaltitle")[
-                        0
-                    ].text.strip()
-                except:
-                    pass
-                # Content Rating
-                metadata.content_rating = ""
-                # content_rating = {}
-                mpaa_rating = ""
-                conuntry_rating = ""
-                try:
-                    mpaa_text = nfo_xml.xpath("./mpaa")[0].text.strip()
-                    match = RATING_REGEX_1.match(mpaa_text)
-                    if match.group("mpaa"):
-                        mpaa_rating = match.group("mpaa")
-                        conuntry_rating = mpaa_rating.split("-", 1)
-                        if "ES" in mpaa_rating:
-                            mpaa_rating = ("es/") + conuntry_rating[1]
-                            log.debug("MPAA Rating: " + mpaa_rating)
-                        else:
-                            mpaa_rating = ("us/") + mpaa_rating
-                            log.debug("MPAA Rating: " + mpaa_rating)
-                        metadata.content_rating = mpaa_rating
-                    else:
-                        metadata.content_rating = "NR"
-                except:
-                    pass
-                # Studio
-                try:
-                    metadata.studio = nfo_xml.xpath("studio")[0].text.strip()
-                except:
-                    pass
-                # Premiere
-                release_string = None
-                try:
-                    log.debug("Reading releasedate tag...")
-                    release_string = nfo_xml.xpath("releasedate")[0].text.strip()
-                    metadata.originally_available_at = parse(release_string)
-                    log.debug(
-                        "Releasedate tag is: {value}".format(value=release_string)
-                    )
-                except:
-                    log.debug("No releasedate tag found...")
-                    pass
-                if not release_string:
-                    try:
-                        log.debug("Reading premiered tag...")
-                        release_string = nfo_xml.xpath("premiered")[0].text.strip()
-                        metadata.originally_available_at = parse(release_string)
-                        log.debug(
-                            "Premiered tag is: {value}".format(value=release_string)
-                        )
-                    except:
-                        log.debug("No premiered tag found...")
-                        pass
-                # Tagline
-                metadata.summary = ""
-                try:
-                    tagline = nfo_xml.xpath("tagline")[0].text.strip()
-                    metadata.tagline = tagline
-                except:
-                    pass
-                # Summary (Outline/Plot)
-                try:
-                    summary = nfo_xml.xpath("plot")[0].text.strip()
-                    metadata.summary = summary
-                except:
-                    log.debug("Exception on reading summary!")
-                    pass
-                # Ratings
-                nfo_rating = None
-                try:
-                    nfo_rating = round(
-                        float(nfo_xml.xpath("rating")[0].text.replace(",", ".")), 1
-                    )
-                    log.debug("Movie Rating found: " + str(nfo_rating))
-                except:
-                    pass
-                if not nfo_rating:
-                    for ratings in nfo_xml.xpath("ratings"):
-                        try:
-                            rating = ratings.xpath("rating")[0]
-                            nfo_rating = round(
-                                float(rating.xpath("value")[0].text.replace(",", ".")),
-                                1,
-                            )
-                        except:
-                            log.debug("Can't read rating from .nfo.")
-                            nfo_rating = 0.0
-                            pass
-                metadata.rating = nfo_rating
-                # Writers (Credits)
-                try:
-                    credits = nfo_xml.xpath("credits")
-                    metadata.writers.clear()
-                    for creditXML in credits:
-                        for c in creditXML.text.split("/"):
-                            metadata.writers.new().name = c.strip()
-                except:
-                    pass
-                # Directors
-                try:
-                    directors = nfo_xml.xpath("director")
-                    metadata.directors.clear()
-                    for directorXML in directors:
-                        for d in directorXML.text.split("/"):
-                            metadata.directors.new().name = d.strip()
-                except:
-                    pass
-                # Genres
-                try:
-                    genres = nfo_xml.xpath("genre")
-                    metadata.genres.clear()
-                    [
-                        metadata.genres.add(g.strip())
-                        for genreXML in genres
-                        for g in genreXML.text.split("/")
-                    ]
-                    metadata.genres.discard("")
-                except:
-                    pass
-                # Countries
-                try:
-                    countries = nfo_xml.xpath("country")
-                    metadata.countries.clear()
-                    [
-                        metadata.countries.add(c.strip())
-                        for countryXML in countries
-                        for c in countryXML.text.split("/")
-                    ]
-                    metadata.countries.discard("")
-                except:
-                    pass
-                # Collections (Set)
-                setname = None
-                # Create a pattern to remove 'Series' and 'Collection' from the end of the
-                # setname since Plex adds 'Collection' in the GUI already
-                setname_pat = re.compile(r"[\s]?(series|collection)$", re.IGNORECASE)
-                metadata.collections.clear()
+        if fresh is None and get_freshness_window():
+            fresh_results.put(
+                path1, capture_title(nfo_file, poster_filename, fanart_filename)
+            )
 
+        log.info("---------------------")
+        log.info("Movie nfo Information")
+        log.info("---------------------")
+        try:
+            log.info("ID: " + str(metadata.guid))
+        except:
+            log.info("ID: -")
+        try:
+            log.info("Title: " + str(metadata.title))
+        except:
+            log.info("Title: -")
+        try:
+            log.info("Sort Title: " + str(metadata.title_sort))
+        except:
+            log.info("Sort Title: -")
+        try:
+            log.info("Year: " + str(metadata.year))
+        except:
+            log.info("Year: -")
+        try:
+            log.info("Original: " + str(metadata.original_title))
+        except:
+            log.info("Original: -")
+        try:
+            log.info("Rating: " + str(metadata.rating))
+        except:
+            log.info("Rating: -")
+        try:
+            log.info("Content: " + str(metadata.content_rating))
+        except:
+            log.info("Content: -")
+        try:
+            log.info("Studio: " + str(metadata.studio))
+        except:
+            log.info("Studio: -")
+        try:
+            log.info("Premiere: " + str(metadata.originally_available_at))
+        except:
+            log.info("Premiere: -")
+        try:
+            log.info("Tagline: " + str(metadata.tagline))
+        except:
+            log.info("Tagline: -")
+        try:
+            log.info("Summary: " + str(metadata.summary))
+        except:
+            log.info("Summary: -")
+        log.info("Writers:")
+        try:
+            [log.info("\t" + writer.name) for writer in metadata.writers]
+        except:
+            log.info("\t-")
+        log.info("Directors:")
+        try:
+            [log.info("\t" + director.name) for director in metadata.directors]
+        except:
+            log.info("\t-")
+        log.info("Genres:")
+        try:
+            [log.info("\t" + genre) for genre in metadata.genres]
+        except:
+            log.info("\t-")
+        log.info("Countries:")
+        try:
+            [log.info("\t" + country) for country in metadata.countries]
+        except:
+            log.info("\t-")
+        log.info("Collections:")
+        try:
+            [log.info("\t" + collection) for collection in metadata.collections]
+        except:
+            log.info("\t-")
+        try:
+            log.info("Duration: {time} min".format(time=metadata.duration // 60000))
+        except:
+            log.info("Duration: -")
+        log.info("Actors:")
+        for actor in metadata.roles:
+            try:
+                log.info("\t{actor.name} > {actor.role}".format(actor=actor))
+            except:
                 try:
-                    sets_list = nfo_reader.read_sets_name()
-                    for setname in sets_list:
-                        setname = setname_pat.sub("", setname.strip())
-                        if setname:  # skip empty name
-                            log.debug("Set name found: " + setname)
-                            metadata.collections.add(setname)
-                            log.debug("Added Collection: {}".format(setname))
-                        else:
-                            log.debug("No set name found...")
-                except Exception as e:
-                    log.error("Raised error when parsing set: {}".format(e))
-                # Duration
-                try:
-                    log.debug(
-                        "Trying to read <durationinseconds> tag from .nfo file..."
-                    )
-                    file_info_xml = element_from_string(nfo_text).xpath("fileinfo")[0]
-                    stream_details_xml = file_info_xml.xpath("streamdetails")[0]
-                    video_xml = stream_details_xml.xpath("video")[0]
-                    runtime = video_xml.xpath("durationinseconds")[0].text.strip()
-                    metadata.duration = (
-                        int(re.compile("^([0-9]+)").findall(runtime)[0]) * 1000
-                    )  # s
-                except:
-                    try:
-                        log.debug("Fallback to <runtime> tag from .nfo file...")
-                        runtime = nfo_xml.xpath("runtime")[0].text.strip()
-                        metadata.duration = (
-                            int(re.compile("^([0-9]+)").findall(runtime)[0]) * 60 * 1000
-                        )  # ms
-                    except:
-                        log.debug("No Duration in .nfo file.")
-                        pass
-                # Actors
-                rroles = []
-                metadata.roles.clear()
-                for n, actor in enumerate(nfo_xml.xpath("actor")):
-                    newrole = metadata.roles.new()
-                    try:
-                        newrole.name = actor.xpath("name")[0].text
-                    except:
-                        newrole.name = "Unknown Name " + str(n)
-                        pass
-                    try:
-                        role = actor.xpath("role")[0].text
-                        if role in rroles:
-                            newrole.role = role + " " + str(n)
-                        else:
-                            newrole.role = role
-                        rroles.append(newrole.role)
-                    except:
-                        newrole.role = "Unknown Role " + str(n)
-                        pass
-                    newrole.photo = ""
-                    try:
-                        newrole.photo = actor.xpath("thumb")[0].text
-                        log.debug("linked actor photo: " + newrole.photo)
-                    except:
-                        log.debug("failed setting linked actor photo!")
-                        pass
-
-                log.info("---------------------")
-                log.info("Movie nfo Information")
-                log.info("---------------------")
-                try:
-                    log.info("ID: " + str(metadata.guid))
-                except:
-                    log.info("ID: -")
-                try:
-                    log.info("Title: " + str(metadata.title))
-                except:
-                    log.info("Title: -")
-                try:
-                    log.info("Sort Title: " + str(metadata.title_sort))
-                except:
-                    log.info("Sort Title: -")
-                try:
-                    log.info("Year: " + str(metadata.year))
-                except:
-                    log.info("Year: -")
-                try:
-                    log.info("Original: " + str(metadata.original_title))
-                except:
-                    log.info("Original: -")
-                try:
-                    log.info("Rating: " + str(metadata.rating))
-                except:
-                    log.info("Rating: -")
-                try:
-                    log.info("Content: " + str(metadata.content_rating))
-                except:
-                    log.info("Content: -")
-                try:
-                    log.info("Studio: " + str(metadata.studio))
-                except:
-                    log.info("Studio: -")
-                try:
-                    log.info("Premiere: " + str(metadata.originally_available_at))
-                except:
-                    log.info("Premiere: -")
-                try:
-                    log.info("Tagline: " + str(metadata.tagline))
-                except:
-                    log.info("Tagline: -")
-                try:
-                    log.info("Summary: " + str(metadata.summary))
-                except:
-                    log.info("Summary: -")
-                log.info("Writers:")
-                try:
-                    [log.info("\t" + writer.name) for writer in metadata.writers]
-                except:
-                    log.info("\t-")
-                log.info("Directors:")
-                try:
-                    [log.info("\t" + director.name) for director in metadata.directors]
-                except:
-                    log.info("\t-")
-                log.info("Genres:")
-                try:
-                    [log.info("\t" + genre) for genre in metadata.genres]
-                except:
-                    log.info("\t-")
-                log.info("Countries:")
-                try:
-                    [log.info("\t" + country) for country in metadata.countries]
-                except:
-                    log.info("\t-")
-                log.info("Collections:")
-                try:
-                    [log.info("\t" + collection) for collection in metadata.collections]
+                    log.info("\t{actor.name}".format(actor=actor))
                 except:
                     log.info("\t-")
-                try:
-                    log.info(
-                        "Duration: {time} min".format(time=metadata.duration // 60000)
-                    )
-                except:
-                    log.info("Duration: -")
-                log.info("Actors:")
-                for actor in metadata.roles:
-                    try:
-                        log.info("\t{actor.name} > {actor.role}".format(actor=actor))
-                    except:
-                        try:
-                            log.info("\t{actor.name}".format(actor=actor))
-                        except:
-                            log.info("\t-")
-                    log.info("---------------------")
-            else:
-                log.info(
-                    "ERROR: No <movie> tag in {nfo}." " Aborting!".format(nfo=nfo_file)
-                )
-            return metadata
+            log.info("---------------------")
+
+        return metadata
 
 
 xbmcnfo = XBMCNFO
@@ -718,7 +758,7 @@ log = XBMCLogAdapter
 
 # -- HELPER FUNCTIONS --------------------------------------------------------
 
-VIDEO_FILE_BASE_REGEX = re.compile(r"(?is)\s*-\s*(cd|dvd|disc|disk|part|pt|d)\s*[0-9]$")
+VIDEO_FILE_BASE_REGEX = LazyRegex(r"(?is)\s*-\s*(cd|dvd|disc|disk|part|pt|d)\s*[0-9]$")
 
 
 def get_base_file(video_file):
@@ -752,11 +792,11 @@ def get_related_file(video_file, file_extension):
     return get_base_file(video_file) + file_extension
 
 
-RELATED_DIRS = {
+RELATED_DIRS = (
     "/",
     "/NFO/",
     "/nfo/",
-}
+)
 
 
 def get_related_files(video_file, file_extension):
@@ -766,7 +806,7 @@ def get_related_files(video_file, file_extension):
 
     :param video_file: the filename of the associated video
     :param file_extension: the related files extension
-    :return: a filename for a related file
+    :return: a list of filenames, one for each of the RELATED_DIRS in order
     """
 
     folder_path, file_name = os.path.split(video_file)
@@ -776,7 +816,7 @@ def get_related_files(video_file, file_extension):
     return results
 
 
-MOVIE_NAME_REGEX = re.compile(r" \(.*\)")
+MOVIE_NAME_REGEX = LazyRegex(r" \(.*\)")
 
 
 def get_movie_name_from_folder(folder_path, with_year):
@@ -787,22 +827,18 @@ def get_movie_name_from_folder(folder_path, with_year):
     :param with_year:
     :return:
     """
-    # Split the folder into a list of paths
-    folder_split = os.path.normpath(folder_path).split(os.sep)
+    folder_path = os.path.normpath(folder_path)
 
-    if folder_split[-1] == "VIDEO_TS":  # If the folder is from a DVD
-        # Strip the VIDEO_TS folder
-        base = os.path.join(*folder_split[1 : len(folder_split) - 1])
-        name = folder_split[-2]
-    else:
-        base = os.path.join(*folder_split)
-        name = folder_split[-1]
+    # If the folder is from a DVD strip the VIDEO_TS folder
+    if os.path.basename(folder_path).upper() == "VIDEO_TS":
+        folder_path = os.path.dirname(folder_path)
+    name = os.path.basename(folder_path)
 
     if with_year:  # then apply the MOVIE_NAME_REGEX to strip year information
         name = MOVIE_NAME_REGEX.sub("", name)
 
     # Append the Movie name from folder to the end of the path
-    movie_name = os.path.join(base, name)
+    movie_name = os.path.join(folder_path, name)
     log.debug(
         "Movie name from folder{with_year}: {name}".format(
             with_year=" (with year)" if with_year else "",
@@ -812,32 +848,6 @@ def get_movie_name_from_folder(folder_path, with_year):
     return movie_name
 
 
-def check_file_paths(file_names, file_type=None):
-    """
-    CHeck a list of file names and return the first one found.
-
-    :param file_names: An iterable of file names to check
-    :param file_type: (Optional) Type of file searched for. Used for logging.
-    :return: a valid filename or None
-    """
-    for filename in file_names:
-        log.debug("Trying {name}".format(name=filename))
-        if os.path.exists(filename):
-            log.info(
-                "Found {type} file {name}".format(
-                    type=file_type if file_type else "a",
-                    name=filename,
-                )
-            )
-            return filename
-    else:
-        log.info(
-            "No {type} file found! Aborting!".format(
-                type=file_type if file_type else "valid"
-            )
-        )
-
-
 def remove_empty_tags(document):
     """
     Removes empty XML tags.
@@ -859,7 +869,20 @@ def remove_empty_tags(document):
     return document
 
 
-UNESCAPE_REGEX = re.compile("&#?\w+;")
+UNESCAPE_REGEX = LazyRegex("&#?\w+;")
+
+
+def get_name2codepoint():
+    """
+    Get the mapping of HTML entity names to code points, imported on first use.
+
+    :return: dict mapping entity names to code points
+    """
+    if sys.version_info < (3, 0):
+        from htmlentitydefs import name2codepoint
+    else:
+        from html.entities import name2codepoint
+    return name2codepoint
 
 
 def unescape(markup):
@@ -887,7 +910,7 @@ def unescape(markup):
                 pass
         else:  # named entity
             try:
-                element = unichr(name2codepoint[element[1:-1]])
+                element = unichr(get_name2codepoint()[element[1:-1]])
             except KeyError:
                 pass
         return element  # leave as is
@@ -895,9 +918,596 @@ def unescape(markup):
     return UNESCAPE_REGEX.sub(fix_up, markup)
 
 
-def extend_file_name(file_names):
-    file_names.extend(list(map(replace_jpg_png, file_names)))
+def read_nfo(nfo_file):
+    """
+    Load and parse a movie's .nfo file.
+
+    :param nfo_file: the .nfo file of the movie
+    :return: the <movie> element with empty tags removed or None
+    """
+    if parse_failures.is_failed(nfo_file):
+        log.info(
+            "Skipping {nfo}, it could not be parsed before and"
+            " has not changed since.".format(nfo=nfo_file)
+        )
+        return None
+    nfo_text = decode_nfo(read_file(nfo_file))
+
+    # work around failing XML parses for things with &'s in
+    # them. This may need to go farther than just &'s....
+    nfo_text = NFO_TEXT_REGEX_1.sub(r"&amp;", nfo_text)
+
+    # remove empty xml tags from nfo
+    log.debug("Removing empty XML tags from movies nfo...")
+    nfo_text = NFO_TEXT_REGEX_2.sub("", nfo_text)
+
+    nfo_text_lower = nfo_text.lower()
+
+    if not (
+        nfo_text_lower.count("<movie") > 0 and nfo_text_lower.count("</movie>") > 0
+    ):
+        log.info("ERROR: No <movie> tag in {nfo}." " Aborting!".format(nfo=nfo_file))
+        parse_failures.add(nfo_file)
+        return None
+
+    # Remove URLs (or other stuff) at the end of the XML file
+    nfo_text = "{content}</movie>".format(content=nfo_text.rsplit("</movie>", 1)[0])
+
+    # likely an xbmc nfo file
+    try:
+        nfo_xml = element_from_string(nfo_text).xpath("//movie")[0]
+    except:
+        log.debug("ERROR: Cant parse XML in {nfo}." " Aborting!".format(nfo=nfo_file))
+        parse_failures.add(nfo_file)
+        return None
+
+    # remove empty xml tags
+    log.debug("Removing empty XML tags from movies nfo...")
+    return remove_empty_tags(nfo_xml)
+
+
+def read_identity(nfo_file):
+    """
+    Read the fields search needs from a movie's .nfo file.
+
+    The start of the file is scanned for them first, the file is only parsed
+    fully if the scan can't tell.
+
+    :param nfo_file: the .nfo file of the movie
+    :return: dict with the texts of the found IDENTITY_FIELDS or None
+    """
+    if parse_failures.is_failed(nfo_file):
+        log.info(
+            "Skipping {nfo}, it could not be parsed before and"
+            " has not changed since.".format(nfo=nfo_file)
+        )
+        return None
+    identity = scan_identity(nfo_file)
+    if identity is not None:
+        log.debug("Read search fields from the start of {nfo}".format(nfo=nfo_file))
+        return identity
+
+    nfo_xml = read_nfo(nfo_file)
+    if nfo_xml is None:
+        return None
+    identity = {}
+    for field in IDENTITY_FIELDS:
+        element = nfo_xml.find(field)
+        if element is not None:
+            identity[field] = element.text
+    return identity
+
+
+def parse_date(date_string):
+    """
+    Parse a date with dateutil, which is imported on first use.
+
+    :param date_string: the date to parse
+    :return: a datetime
+    """
+    from dateutil.parser import parse
+
+    return parse(date_string)
+
+
+def get_record_snapshot():
+    """
+    Get the record snapshot, which is imported on first use.
+
+    :return: the RecordSnapshot
+    """
+    from snapshot import record_snapshot
+
+    return record_snapshot
+
+
+def resolve_title_files(plan):
+    """
+    Find the nfo, poster and fanart of a title.
+
+    :param plan: the PathPlan of the title's media file
+    :return: tuple (nfo file, poster, fanart), None for missing files
+    """
+    # check possible .nfo file locations
+    nfo_file = resolve_file(
+        plan.library_root, "nfo", plan.nfo, ".nfo", folder_path=plan.title_root
+    )
+
+    # if not preferences["localmediaagent"]:
+    # check possible poster file locations
+    poster_filename = resolve_file(
+        plan.library_root,
+        "poster",
+        plan.poster,
+        "poster",
+        folder_path=plan.title_root,
+    )
+
+    # check possible fanart file locations
+    fanart_filename = resolve_file(
+        plan.library_root,
+        "fanart",
+        plan.fanart,
+        "fanart",
+        folder_path=plan.title_root,
+    )
+    return nfo_file, poster_filename, fanart_filename
+
+
+def apply_record(metadata, record):
+    """
+    Apply the core fields of an nfo record to the metadata.
+
+    Title, sort title, year, rating and summary come first, followed by
+    the remaining text fields.
+
+    :param metadata: the metadata to update
+    :param record: dict returned by NFOReader.read_record
+    """
+    metadata.title = record["title"]
+    if record.get("title_sort"):
+        metadata.title_sort = record["title_sort"]
+    if record.get("year"):
+        metadata.year = record["year"]
+    metadata.rating = record.get("rating")
+    metadata.summary = record.get("summary", "")
+    if record.get("tagline"):
+        metadata.tagline = record["tagline"]
+    if record.get("original_title"):
+        metadata.original_title = record["original_title"]
+    metadata.content_rating = record.get("content_rating", "")
+    if record.get("studio"):
+        metadata.studio = record["studio"]
+    if record.get("release_date"):
+        try:
+            metadata.originally_available_at = parse_date(record["release_date"])
+        except:
+            log.debug(
+                "Can't parse release date: {value}".format(value=record["release_date"])
+            )
+    metadata.writers.clear()
+    for name in record.get("writers", []):
+        metadata.writers.new().name = name
+    metadata.directors.clear()
+    for name in record.get("directors", []):
+        metadata.directors.new().name = name
+    metadata.genres.clear()
+    for genre in record.get("genres", []):
+        metadata.genres.add(genre)
+    metadata.countries.clear()
+    for country in record.get("countries", []):
+        metadata.countries.add(country)
+    metadata.collections.clear()
+    for collection in record.get("collections", []):
+        metadata.collections.add(collection)
+        log.debug("Added Collection: {}".format(collection))
+
+
+def set_artwork(container, filename, data):
+    """
+    Replace the artwork of a metadata container (posters, art).
+
+    :param container: the metadata container to update
+    :param filename: the filename of the artwork
+    :param data: the artwork's data
+    """
+    for key in container.keys():
+        del container[key]
+    container[filename] = MediaProxy(data)
+
+
+def set_duration(metadata, duration):
+    """
+    Set the duration read from the nfo, if any.
+
+    :param metadata: the metadata to update
+    :param duration: duration in milliseconds or None
+    """
+    if duration:
+        metadata.duration = duration
+
+
+def get_max_actors():
+    """
+    Get the maximum number of actors from the preferences.
+
+    :return: the maximum number of actors, 0 for no limit
+    """
+    try:
+        return max(int(preferences["maxactors"] or 0), 0)
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+def set_roles(metadata, roles, limit=0):
+    """
+    Replace the roles of the metadata.
+
+    :param metadata: the metadata to update
+    :param roles: list of (name, role, photo) tuples
+    :param limit: maximum number of roles, 0 for no limit
+    """
+    metadata.roles.clear()
+    for name, role, photo in roles[:limit] if limit else roles:
+        newrole = metadata.roles.new()
+        newrole.name = name
+        newrole.role = role
+        newrole.photo = photo
+
+
+def set_subtitles(part, subtitle_files):
+    """
+    Add found subtitle files to a media part and remove stale ones.
+
+    :param part: the media part to update
+    :param subtitle_files: list of subtitle files found for the part
+    """
+    add_subtitle_files(part, subtitle_files)
+    cleanup_subtitle_entries(part, subtitle_files)
+
+
+def set_extras(metadata, extras):
+    """
+    Set the local trailers and extras found by find_local_extras.
+
+    :param metadata: the metadata of the movie
+    :param extras: list of (kind, title, path) tuples
+    """
+    extra_types = {"trailer": Trailer, "featurette": Featurette}
+    metadata.extras.clear()
+    for kind, title, path in extras:
+        log.debug("Adding local {kind}: {path}".format(kind=kind, path=path))
+        metadata.extras.add(extra_types[kind](title=title, file=path))
 
 
 def replace_jpg_png(path):
     return path.replace("jpg", "png")
+
+
+def is_below(path, root):
+    """
+    Check whether a path is a folder or inside of it.
+
+    :param path: the path to check
+    :param root: the folder, None for any folder
+    :return: True if the path is the folder or inside of it
+    """
+    if root is None:
+        return True
+    root = root.rstrip(os.sep)
+    return path == root or path.startswith(root + os.sep)
+
+
+# -- AGENT MODULES -----------------------------------------------------------
+# These modules import the helpers above from this module, so they have to be
+# imported after everything they use has been defined.
+
+from resolver import candidate_stats
+from resolver import get_path_plan
+from resolver import negative_cache
+from resolver import path_plans
+from resolver import resolve_file
+from stages import Deadline
+from stages import completion_queue
+from stages import get_update_budget
+from stages import run_stage
+from subtitles import add_subtitle_files
+from subtitles import cleanup_subtitle_entries
+from subtitles import find_subtitle_files
+from subtitles import idx_cache
+from aliases import artwork_aliases
+from aliases import load_artwork
+from aliases import nfo_aliases
+from extras import EXTRA_FOLDERS
+from extras import EXTRA_SUFFIXES
+from extras import VIDEO_EXTENSIONS
+from extras import find_local_extras
+from nfo import IDENTITY_FIELDS
+from nfo import decode_nfo
+from nfo import parse_failures
+from nfo import scan_identity
+from readahead import prefetch
+from readahead import read_file
+from readahead import read_scheduler
+from listing import folder_listings
+from listing import get_folder_listing
+from discs import find_disc_entry
+from freshness import capture_title
+from freshness import fresh_results
+from freshness import get_freshness_window
+
+# -- STARTUP -----------------------------------------------------------------
+
+startup_timing = {"import": time.time() - IMPORT_START}
+
+
+def warm_up():
+    """
+    Preload persisted indexes in the background.
+    """
+    start = time.time()
+    steps = (
+        ("date parser", lambda: parse_date("2000-01-01")),
+        ("regular expressions", warm_up_regexes),
+        ("candidate stats", candidate_stats.roots),
+        ("snapshot", lambda: get_record_snapshot().stats()),
+    )
+    for name, step in steps:
+        step_start = time.time()
+        try:
+            step()
+        except Exception as e:
+            log.error("Warm-up of {name} failed: {error}".format(name=name, error=e))
+        startup_timing["warm-up " + name] = time.time() - step_start
+    startup_timing["warm-up"] = time.time() - start
+    log.info("Warm-up done in {time:.3f}s".format(time=startup_timing["warm-up"]))
+
+
+def warm_up_regexes():
+    """
+    Compile the regular expressions used for every title.
+    """
+    for regex in (
+        NFO_TEXT_REGEX_1,
+        NFO_TEXT_REGEX_2,
+        RATING_REGEX_1,
+        DURATION_REGEX,
+        SET_NAME_REGEX,
+        VIDEO_FILE_BASE_REGEX,
+        MOVIE_NAME_REGEX,
+    ):
+        regex.compile()
+
+
+def Start():
+    """
+    Called by Plex when the plugin starts.
+    """
+    log.info("Code loaded in {time:.3f}s".format(time=startup_timing["import"]))
+    if preferences["warmup"]:
+        create_thread(warm_up)
+
+
+# -- CACHE CONTROL -----------------------------------------------------------
+# The caches are reported, flushed and pre-warmed through the plugin's HTTP
+# routes, see tools/cache_control.py for a command line client.
+
+CONTROL_PREFIX = "/agents/xbmcnfo"
+
+caches = None
+caches_lock = threading.Lock()
+
+
+def get_caches():
+    """
+    Get the registry of the caches, which is created by the first control
+    request.
+
+    The registry, the snapshot, the memory tracker and the call profiler are
+    imported then, they are not needed to start the plugin.
+
+    :return: the CacheRegistry
+    """
+    global caches
+    with caches_lock:
+        if caches is not None:
+            return caches
+        from introspection import CacheRegistry
+        from memory import memory_tracker
+        from profiler import call_profiler
+
+        registry = CacheRegistry(exclude=(persistent_dict,))
+        for name, cache in (
+            ("path_plans", path_plans),
+            ("fresh", fresh_results),
+            ("listings", folder_listings),
+            ("candidate_hits", candidate_stats),
+            ("negative", negative_cache),
+            ("parse_failures", parse_failures),
+            ("nfo_records", nfo_aliases),
+            ("snapshot", get_record_snapshot()),
+            ("artwork", artwork_aliases),
+            ("idx_languages", idx_cache),
+            ("completion_queue", completion_queue),
+            ("reads", read_scheduler),
+            ("memory", memory_tracker),
+            ("profile", call_profiler),
+        ):
+            registry.register(name, cache, started=IMPORT_START)
+        caches = registry
+    return caches
+
+
+def get_report(footprint=True):
+    """
+    :param footprint: also estimate the memory footprint of the caches
+    :return: dict with the statistics of all caches and the startup timing
+    """
+    return {
+        "caches": get_caches().stats(footprint),
+        "startup": dict(startup_timing),
+    }
+
+
+def find_titles(path, depth=2):
+    """
+    Find the media files of the titles in a library root or title folder.
+
+    :param path: a media file, title folder or library root
+    :param depth: number of folder levels to descend into
+    :return: list of media files
+    """
+    if os.path.isfile(path):
+        return [path]
+    listing = get_folder_listing(path)
+    if listing is None:
+        return []
+    titles = []
+    for name in listing.files:
+        stem, extension = os.path.splitext(name)
+        if extension.lower() not in VIDEO_EXTENSIONS:
+            continue
+        if any(stem.lower().endswith(suffix) for suffix, _ in EXTRA_SUFFIXES):
+            continue
+        titles.append(os.path.join(path, name))
+    for name in listing.folders:
+        disc_entry = find_disc_entry(path, name)
+        if disc_entry:
+            titles.append(disc_entry)
+    if titles or not depth:
+        return titles
+    for name in listing.folders:
+        if name.lower() not in EXTRA_FOLDERS:
+            titles.extend(find_titles(os.path.join(path, name), depth - 1))
+    return titles
+
+
+def warm_title(video_file):
+    """
+    Fill the caches for a title the way update does.
+
+    :param video_file: the media file of the title
+    :return: True if a record of the title's nfo is cached
+    """
+    return warm_files(*resolve_title_files(get_path_plan(video_file)))
+
+
+def warm_files(nfo_file, poster, fanart):
+    """
+    Fill the caches with the resolved files of a title.
+
+    :param nfo_file: the nfo file or None
+    :param poster: the poster or None
+    :param fanart: the fanart or None
+    :return: True if a record of the nfo is cached
+    """
+    for artwork in (poster, fanart):
+        if artwork:
+            load_artwork(artwork)
+    if not nfo_file:
+        return False
+    if nfo_aliases.get(nfo_file) is not None:
+        return True
+    record_snapshot = get_record_snapshot()
+    record = record_snapshot.lookup(nfo_file)
+    if record is None:
+        nfo_xml = read_nfo(nfo_file)
+        if nfo_xml is None:
+            return False
+        nfo_reader = NFOReader(nfo_xml)
+        record = nfo_reader.read_record()
+        if record is None:
+            return False
+        record["duration"] = nfo_reader.read_duration()
+        record["roles"] = nfo_reader.read_roles()
+        record_snapshot.add(nfo_file, record)
+    nfo_aliases.put(nfo_file, record)
+    return True
+
+
+def revalidate_title(video_file, old):
+    """
+    Check the files of a title served from the freshness window again.
+
+    Changed files are extracted into the caches again.
+
+    :param video_file: the media file of the title
+    :param old: the FreshEntry that was served or None
+    :return: a FreshEntry of the files as they are now
+    """
+    files = resolve_title_files(get_path_plan(video_file))
+    entry = capture_title(*files)
+    if old is None or entry.signature != old.signature:
+        log.info(
+            "Files of {file} changed, extracting them again".format(file=video_file)
+        )
+        warm_files(*files)
+    return entry
+
+
+def warm_path(path):
+    """
+    Pre-warm the caches for all titles in a library root or title folder.
+
+    :param path: a media file, title folder or library root
+    """
+    start = time.time()
+    titles = find_titles(path)
+    cached = 0
+    for video_file in titles:
+        try:
+            cached += warm_title(video_file)
+        except Exception as e:
+            log.error(
+                "Pre-warming {name} failed: {error}".format(name=video_file, error=e)
+            )
+    log.info(
+        "Pre-warmed {path!r} in {time:.2f}s: {titles} titles,"
+        " {cached} records cached".format(
+            path=path, time=time.time() - start, titles=len(titles), cached=cached
+        )
+    )
+
+
+def get_control_path(path):
+    """
+    Validate a path passed to a control route.
+
+    :param path: the path, empty for none
+    :return: the normalized path or None
+    """
+    if not path:
+        return None
+    if not os.path.isabs(path):
+        raise ValueError("Not an absolute path: {path!r}".format(path=path))
+    return os.path.normpath(path)
+
+
+@plugin_handler(CONTROL_PREFIX, "XBMCnfoMoviesImporter")
+def control_main():
+    return json_from_object(get_report(footprint=False))
+
+
+@plugin_route(CONTROL_PREFIX + "/stats")
+def control_stats(footprint="1"):
+    return json_from_object(get_report(footprint not in ("0", "false")))
+
+
+@plugin_route(CONTROL_PREFIX + "/flush")
+def control_flush(path=None):
+    try:
+        return json_from_object({"flushed": get_caches().flush(get_control_path(path))})
+    except ValueError as e:
+        return json_from_object({"error": str(e)})
+
+
+@plugin_route(CONTROL_PREFIX + "/warm")
+def control_warm(path=None):
+    try:
+        path = get_control_path(path)
+    except ValueError as e:
+        return json_from_object({"error": str(e)})
+    if path is None or not os.path.exists(path):
+        return json_from_object({"error": "No such path: {path!r}".format(path=path)})
+    create_thread(warm_path, path)
+    return json_from_object({"warming": path})
@@ -0,0 +1,187 @@
+# coding=utf-8
+
+"""
+Deduplication of files reached through several paths.
+
+The same movie folder can be exposed through several libraries, symlinked
+trees or bind mounts. Results are cached by the canonical identity of the
+file (device and inode), so every alias after the first one is served from
+the first one's record or payload instead of being read and parsed again.
+
+Records are kept in the compact encoding of the compact module, limited by
+the recordcachesize preference.
+"""
+
+import os
+
+from __init__ import log
+from compact import decode_record
+from compact import encode_record
+from compact import get_record_cache_size
+from compact import record_weight
+from lru import LRUCache
+from readahead import read_file
+
+
+def get_identity(path):
+    """
+    Get the canonical identity of a file.
+
+    :param path: the path of the file
+    :return: tuple (identity, stat) or (None, None) if the file is missing
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+    return (stat.st_dev, stat.st_ino), stat
+
+
+class IdentityCache(LRUCache):
+    """
+    LRU cache keyed by file identity, validated by mtime and size.
+
+    :param name: name of the cache, used for logging
+    :param limit: maximum total weight of the cached values, or a callable
+        returning it
+    :param weigh: callable returning the weight of a stored value, defaults
+        to 1
+    :param encode: (Optional) callable converting values for storage
+    :param decode: (Optional) callable converting stored values back
+    """
+
+    def __init__(self, name, limit, weigh=None, encode=None, decode=None):
+        # entries are tuples (mtime, size, path, value, weight)
+        super(IdentityCache, self).__init__(limit, weigh=lambda entry: entry[4])
+        self.name = name
+        self._weigh_value = weigh or (lambda value: 1)
+        self._encode = encode
+        self._decode = decode
+        self.alias_hits = 0
+
+    @staticmethod
+    def path_of(identity, entry):
+        return entry[2]
+
+    def get(self, path, stat=None):
+        """
+        Get the value cached for a file.
+
+        :param path: the path of the file
+        :param stat: (Optional) os.stat result of the file
+        :return: the cached value or None
+        """
+        if stat is None:
+            identity, stat = get_identity(path)
+        else:
+            identity = (stat.st_dev, stat.st_ino)
+        if identity is None:
+            return None
+        current = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._find(identity, lambda entry: entry[:2] == current)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] == path:
+                self.hits += 1
+            else:
+                self.alias_hits += 1
+        if entry[2] != path:
+            log.debug(
+                "{name} of {path} served from alias {alias}".format(
+                    name=self.name, path=path, alias=entry[2]
+                )
+            )
+        return self._decode(entry[3]) if self._decode else entry[3]
+
+    def contains(self, path):
+        """
+        Check whether a value is cached for a file, without counting a hit or
+        a miss.
+
+        :param path: the path of the file
+        :return: True if the cached value is current
+        """
+        identity, stat = get_identity(path)
+        if identity is None:
+            return False
+        with self._lock:
+            entry = self._entries.get(identity)
+        return entry is not None and entry[:2] == (stat.st_mtime, stat.st_size)
+
+    def put(self, path, value, stat=None):
+        """
+        Cache the value of a file.
+
+        :param path: the path of the file
+        :param value: the value to cache
+        :param stat: (Optional) os.stat result of the file
+        """
+        if stat is None:
+            identity, stat = get_identity(path)
+        else:
+            identity = (stat.st_dev, stat.st_ino)
+        if identity is None:
+            return
+        if self._encode:
+            value = self._encode(value)
+        weight = self._weigh_value(value)
+        if weight > self.limit:
+            return
+        with self._lock:
+            self._store(identity, (stat.st_mtime, stat.st_size, path, value, weight))
+
+    def load(self, path, loader):
+        """
+        Get the value of a file, loading and caching it on a miss.
+
+        :param path: the path of the file
+        :param loader: callable loading the value of the file
+        :return: the value
+        """
+        identity, stat = get_identity(path)
+        value = self.get(path, stat) if identity else None
+        if value is None:
+            value = loader(path)
+            if identity and value is not None:
+                self.put(path, value, stat)
+        return value
+
+    def stats(self):
+        """
+        :return: dict with entry count, weight, hits, alias hits, misses and
+            evictions
+        """
+        stats = super(IdentityCache, self).stats()
+        with self._lock:
+            stats.update(
+                {
+                    "weight": self._weight,
+                    "limit": self.limit,
+                    "alias_hits": self.alias_hits,
+                }
+            )
+        return stats
+
+
+# Complete nfo records, compactly encoded, limited by size in bytes.
+nfo_aliases = IdentityCache(
+    "nfo record",
+    get_record_cache_size,
+    weigh=record_weight,
+    encode=encode_record,
+    decode=decode_record,
+)
+# Artwork data, limited by size in bytes.
+artwork_aliases = IdentityCache("artwork", 64 * 1024 * 1024, weigh=len)
+
+
+def load_artwork(path):
+    """
+    Load artwork data, shared between all aliases of the file.
+
+    :param path: the path of the artwork
+    :return: the artwork's data
+    """
+    return artwork_aliases.load(path, read_file)
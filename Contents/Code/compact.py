@@ -0,0 +1,156 @@
+# coding=utf-8
+
+"""
+Compact in-memory representation of nfo records.
+
+Kept as Python objects, a record with its summary and actor list costs
+several kilobytes, so a whole library does not fit into memory. Cached records
+are stored as marshal encoded bytes instead: the short fields together in one
+buffer, every field that encodes to more than INLINE_LIMIT bytes (summaries,
+long actor lists) out of line in its own buffer, zlib compressed when the
+recordcompress preference is set. A cached record is decoded into a
+CompactRecord view, which decodes the short fields at once and each large
+field only when it is accessed.
+"""
+
+import marshal
+import numbers
+import sys
+import zlib
+
+from __init__ import log
+from __init__ import preferences
+
+PY2 = sys.version_info[0] == 2
+TEXT_TYPE = unicode if PY2 else str  # noqa: F821
+
+# Fields encoding to more bytes than this are stored out of line.
+INLINE_LIMIT = 256
+# marshal format shared by all supported Python versions
+MARSHAL_VERSION = 2
+COMPRESS_LEVEL = 1
+# Estimated memory of a stored record besides its buffers.
+RECORD_OVERHEAD = 200
+DEFAULT_CACHE_SIZE = 32
+
+
+def get_record_cache_size():
+    """
+    Get the memory ceiling of the record cache from the preferences.
+
+    :return: size in bytes
+    """
+    try:
+        size = float(preferences["recordcachesize"])
+    except (KeyError, TypeError, ValueError):
+        size = DEFAULT_CACHE_SIZE
+    return int(max(size, 0) * 1024 * 1024)
+
+
+def use_compression():
+    try:
+        return bool(preferences["recordcompress"])
+    except KeyError:
+        return True
+
+
+def plain(value):
+    """
+    Convert a value to the exact built-in types marshal accepts.
+    """
+    if isinstance(value, bytes):
+        return bytes(value)
+    if isinstance(value, TEXT_TYPE):
+        return TEXT_TYPE(value)
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, tuple):
+        return tuple(plain(item) for item in value)
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return TEXT_TYPE(value)
+
+
+def encode_record(record):
+    """
+    Encode a record for the cache.
+
+    :param record: dict or record view with keys() and item access
+    :return: tuple (inline buffer, dict of large field buffers, compressed)
+    """
+    compress = use_compression()
+    inline = {}
+    large = {}
+    for key in record.keys():
+        value = plain(record[key])
+        data = marshal.dumps(value, MARSHAL_VERSION)
+        if len(data) <= INLINE_LIMIT:
+            inline[plain(key)] = value
+        else:
+            large[plain(key)] = (
+                zlib.compress(data, COMPRESS_LEVEL) if compress else data
+            )
+    return marshal.dumps(inline, MARSHAL_VERSION), large, compress
+
+
+def record_weight(stored):
+    """
+    :param stored: an encoded record
+    :return: estimated memory of the encoded record in bytes
+    """
+    inline, large, _ = stored
+    return RECORD_OVERHEAD + len(inline) + sum(len(data) for data in large.values())
+
+
+class CompactRecord(object):
+    """
+    Read-only view of an encoded record.
+
+    Supports the parts of the dict interface apply_record needs.
+    """
+
+    __slots__ = ("_inline", "_large", "_compressed")
+
+    def __init__(self, stored):
+        inline, self._large, self._compressed = stored
+        self._inline = marshal.loads(inline)
+
+    def __getitem__(self, key):
+        try:
+            return self._inline[key]
+        except KeyError:
+            data = self._large[key]
+        if self._compressed:
+            data = zlib.decompress(data)
+        return marshal.loads(data)
+
+    def __contains__(self, key):
+        return key in self._inline or key in self._large
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._inline) + list(self._large)
+
+    def to_dict(self):
+        return dict((key, self[key]) for key in self.keys())
+
+
+def decode_record(stored):
+    """
+    :param stored: an encoded record
+    :return: a CompactRecord view of it
+    """
+    try:
+        return CompactRecord(stored)
+    except (EOFError, ValueError, TypeError, zlib.error) as e:
+        log.error("Unable to decode cached record: {error}".format(error=e))
+        return None
@@ -0,0 +1,87 @@
+# coding=utf-8
+
+"""
+Disc structure detection.
+
+Ripped discs keep their media files inside a fixed folder structure:
+
+- DVD: ``<title>/VIDEO_TS/VIDEO_TS.IFO``, ``VTS_01_1.VOB``, ...
+- Blu-ray: ``<title>/BDMV/index.bdmv`` and ``<title>/BDMV/STREAM/00000.m2ts``
+- disc images: ``<title>/<movie>.iso``
+
+The nfo and the artwork of such a title live in the title folder, not next to
+the media file, so the resolver looks them up there instead of probing the
+disc structure. The layout only depends on the media file's path and is
+detected without touching the disk; the path plans built from it are cached
+by the resolver.
+"""
+
+import os
+from collections import namedtuple
+
+# upper case disc folder name: entry file of the disc
+DISC_FOLDERS = {"VIDEO_TS": "VIDEO_TS.IFO", "BDMV": "index.bdmv"}
+IMAGE_EXTENSIONS = frozenset((".iso", ".img"))
+
+
+class DiscLayout(namedtuple("DiscLayout", ("layout", "title_root", "disc_nfo"))):
+    """
+    Layout of a media folder.
+
+    layout: "video_ts", "bdmv", "iso" or None for plain folders
+    title_root: the folder holding the title's nfo and artwork
+    disc_nfo: the nfo stored inside the disc structure or None
+    """
+
+    __slots__ = ()
+
+
+def detect_layout(folder_path):
+    """
+    Detect the disc structure a media folder belongs to.
+
+    :param folder_path: the folder of the media file
+    :return: a DiscLayout
+    """
+    folder_path = os.path.normpath(folder_path)
+    name = os.path.basename(folder_path).upper()
+    parent = os.path.dirname(folder_path)
+    if name == "VIDEO_TS":
+        return DiscLayout("video_ts", parent, os.path.join(folder_path, "VIDEO_TS.nfo"))
+    if name == "BDMV":
+        return DiscLayout("bdmv", parent, os.path.join(folder_path, "index.nfo"))
+    if name == "STREAM" and os.path.basename(parent).upper() == "BDMV":
+        return DiscLayout(
+            "bdmv", os.path.dirname(parent), os.path.join(parent, "index.nfo")
+        )
+    return DiscLayout(None, folder_path, None)
+
+
+def get_disc_layout(video_file):
+    """
+    Get the layout of a media file.
+
+    :param video_file: the media file
+    :return: a DiscLayout
+    """
+    layout = detect_layout(os.path.dirname(video_file))
+    if layout.layout is None:
+        extension = os.path.splitext(video_file)[1].lower()
+        if extension in IMAGE_EXTENSIONS:
+            return layout._replace(layout="iso")
+    return layout
+
+
+def find_disc_entry(folder_path, folder_name):
+    """
+    Get the entry file of a disc folder.
+
+    :param folder_path: the title folder
+    :param folder_name: the name of a subfolder of the title folder
+    :return: the path of the disc's entry file or None if the subfolder is no
+        disc folder
+    """
+    entry = DISC_FOLDERS.get(folder_name.upper())
+    if entry is None:
+        return None
+    return os.path.join(folder_path, folder_name, entry)
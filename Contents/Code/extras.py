@@ -0,0 +1,90 @@
+# coding=utf-8
+
+"""
+Local trailer and extras discovery.
+
+Trailers and extras are looked up in the cached listing of the title folder:
+
+- ``<movie>-trailer.<ext>`` files next to the movie, matched against the
+  movie's base file the same way get_base_file strips CD / part information
+- every video in a ``Trailers`` subfolder as trailer
+- every video in an ``Extras`` subfolder as featurette
+
+Subfolders are only listed when the title folder's listing shows them, so a
+title without extras costs no filesystem calls beyond that listing.
+"""
+
+import os
+
+from __init__ import get_base_file
+from __init__ import log
+from listing import get_folder_listing
+
+VIDEO_EXTENSIONS = frozenset(
+    (
+        ".avi",
+        ".divx",
+        ".flv",
+        ".iso",
+        ".m2ts",
+        ".m4v",
+        ".mkv",
+        ".mov",
+        ".mp4",
+        ".mpeg",
+        ".mpg",
+        ".ogm",
+        ".ts",
+        ".webm",
+        ".wmv",
+    )
+)
+# (suffix of files next to the movie, kind of extra)
+EXTRA_SUFFIXES = (("-trailer", "trailer"),)
+# lower case subfolder name: kind of extra
+EXTRA_FOLDERS = {"trailers": "trailer", "extras": "featurette"}
+
+
+def find_local_extras(plan):
+    """
+    Find the local trailers and extras of a title.
+
+    :param plan: the PathPlan of the title's media file
+    :return: list of (kind, title, path) tuples
+    """
+    title_folder = plan.title_root
+    listing = get_folder_listing(title_folder)
+    if listing is None:
+        return []
+
+    extras = []
+    for name in listing.files:
+        stem, extension = os.path.splitext(name)
+        if extension.lower() not in VIDEO_EXTENSIONS:
+            continue
+        for suffix, kind in EXTRA_SUFFIXES:
+            if not stem.lower().endswith(suffix):
+                continue
+            if get_base_file(stem[: -len(suffix)] + extension) == plan.base_stem:
+                extras.append((kind, stem, os.path.join(title_folder, name)))
+            break
+
+    for folder in listing.folders:
+        kind = EXTRA_FOLDERS.get(folder.lower())
+        if kind is None:
+            continue
+        folder_path = os.path.join(title_folder, folder)
+        folder_listing = get_folder_listing(folder_path)
+        if folder_listing is None:
+            continue
+        for name in folder_listing.files:
+            stem, extension = os.path.splitext(name)
+            if extension.lower() in VIDEO_EXTENSIONS:
+                extras.append((kind, stem, os.path.join(folder_path, name)))
+
+    log.debug(
+        "Local extras in {path!r}: {number}".format(
+            path=title_folder, number=len(extras) or "none"
+        )
+    )
+    return extras
@@ -0,0 +1,188 @@
+# coding=utf-8
+
+"""
+Stale-while-revalidate for the nfo and artwork of a title.
+
+Every update checks the title's nfo and artwork against the disk, a stat per
+candidate and file, which adds up on slow network mounts. With a freshness
+window set, update remembers the files it resolved for a media file and the
+nfo's stat. Within the window the next update serves the cached record and
+keeps the attached artwork without touching the disk, and a background thread
+checks the files again. Unchanged files start a new window; when a file
+changed, the record and artwork are extracted again and the next update
+applies them the usual way.
+"""
+
+import os
+import time
+from collections import namedtuple
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from __init__ import create_thread
+from __init__ import log
+from __init__ import preferences
+from lru import LRUCache
+
+# Number of titles kept in memory.
+FRESH_LIMIT = 5000
+
+
+def get_freshness_window():
+    """
+    Get the freshness window from the preferences.
+
+    :return: window in seconds, 0 if disabled
+    """
+    try:
+        return max(float(preferences["freshwindow"] or 0), 0)
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+class FreshEntry(
+    namedtuple(
+        "FreshEntry",
+        ("validated", "nfo_file", "nfo_stat", "poster", "fanart", "signature"),
+    )
+):
+    """
+    Files of a title at the time they were last checked.
+
+    validated: time of the check
+    nfo_file, poster, fanart: the resolved files or None
+    nfo_stat: os.stat result of the nfo file or None
+    signature: tuple of (path, mtime, size) of the files, None for missing ones
+    """
+
+    __slots__ = ()
+
+
+def capture_title(nfo_file, poster, fanart):
+    """
+    Check the resolved files of a title.
+
+    :param nfo_file: the nfo file or None
+    :param poster: the poster or None
+    :param fanart: the fanart or None
+    :return: a FreshEntry
+    """
+    stats = []
+    signature = []
+    for path in (nfo_file, poster, fanart):
+        try:
+            stat = os.stat(path) if path else None
+        except OSError:
+            stat = None
+        stats.append(stat)
+        signature.append((path, stat.st_mtime, stat.st_size) if stat else None)
+    return FreshEntry(time.time(), nfo_file, stats[0], poster, fanart, tuple(signature))
+
+
+class FreshResults(LRUCache):
+    """
+    Resolved files of recently updated titles, revalidated in the background.
+    """
+
+    def __init__(self, limit=FRESH_LIMIT):
+        super(FreshResults, self).__init__(limit)
+        self._queue = Queue()
+        self._pending = set()
+        self._worker = None
+        self.stale_serves = 0
+        self.expired = 0
+        self.revalidated = 0
+        self.refreshed = 0
+        self.failed = 0
+
+    def lookup(self, video_file):
+        """
+        Get the files of a title if they were checked within the window.
+
+        :param video_file: the media file of the title
+        :return: a FreshEntry or None
+        """
+        window = get_freshness_window()
+        if not window:
+            return None
+        with self._lock:
+            entry = self._find(video_file)
+            if entry is not None and time.time() - entry.validated > window:
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def serve(self, video_file, revalidate):
+        """
+        Count a stale serve and queue the title's revalidation.
+
+        :param video_file: the media file of the title
+        :param revalidate: callable taking the media file and the served
+            FreshEntry, checking the title's files again, extracting them if
+            they changed, and returning a new FreshEntry
+        """
+        with self._lock:
+            self.stale_serves += 1
+            if video_file in self._pending:
+                return
+            self._pending.add(video_file)
+            if self._worker is None:
+                self._worker = create_thread(self._work)
+        self._queue.put((video_file, revalidate))
+
+    def _work(self):
+        while True:
+            video_file, revalidate = self._queue.get()
+            with self._lock:
+                old = self._entries.get(video_file)
+            try:
+                entry = revalidate(video_file, old)
+            except Exception as e:
+                log.error(
+                    "Revalidation of {file} failed: {error}".format(
+                        file=video_file, error=e
+                    )
+                )
+                entry = None
+            with self._lock:
+                self._pending.discard(video_file)
+                if entry is None:
+                    self.failed += 1
+                    self._remove(video_file)
+                elif old is not None and entry.signature == old.signature:
+                    self.revalidated += 1
+                    self._store(video_file, entry)
+                else:
+                    # the next update applies the new files in full
+                    self.refreshed += 1
+                    self._remove(video_file)
+
+    def stats(self):
+        """
+        :return: dict with the window, entries, hits, misses, stale serves and
+            revalidation counters
+        """
+        stats = super(FreshResults, self).stats()
+        with self._lock:
+            stats.update(
+                {
+                    "window": get_freshness_window(),
+                    "pending": len(self._pending),
+                    "stale_serves": self.stale_serves,
+                    "expired": self.expired,
+                    "revalidated": self.revalidated,
+                    "refreshed": self.refreshed,
+                    "failed": self.failed,
+                }
+            )
+        return stats
+
+
+fresh_results = FreshResults()
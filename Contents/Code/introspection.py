@@ -0,0 +1,149 @@
+# coding=utf-8
+
+"""
+Introspection and control of the agent's caches.
+
+Every cache registers itself under a name. The registry reports each cache's
+own counters plus a hit rate, an estimate of its memory footprint and its age
+(the time since it was started or last flushed). Caches are flushed as a
+whole or for a library root or a single title folder through their
+discard(root) method.
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from __init__ import log
+
+# Types that are counted but not walked into by estimate_size.
+OPAQUE_TYPES = (type, type(sys), type(len), type(lambda: None))
+
+
+def estimate_size(obj, exclude=()):
+    """
+    Estimate the memory used by an object and everything it references.
+
+    Callables, classes and modules are not followed.
+
+    :param obj: the object
+    :param exclude: objects that are not counted, e.g. shared stores
+    :return: size in bytes
+    """
+    seen = set(id(o) for o in exclude)
+    stack = [obj]
+    total = 0
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        try:
+            total += sys.getsizeof(current)
+        except TypeError:
+            continue
+        if isinstance(current, OPAQUE_TYPES) or callable(current):
+            continue
+        if isinstance(current, dict):
+            for item in list(current.items()):
+                stack.extend(item)
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(list(current))
+        elif hasattr(current, "__dict__"):
+            stack.append(current.__dict__)
+    return total
+
+
+class CacheRegistry(object):
+    """
+    Named caches with stats() and, optionally, discard(root) methods.
+
+    :param exclude: objects that are not counted in the memory footprint
+    """
+
+    def __init__(self, exclude=()):
+        self._lock = threading.Lock()
+        self._caches = OrderedDict()
+        self._started = {}
+        self._exclude = tuple(exclude)
+
+    def register(self, name, cache, started=None):
+        """
+        :param name: name of the cache in the reports
+        :param cache: the cache
+        :param started: (Optional) when the cache was started, now if None
+        """
+        with self._lock:
+            self._caches[name] = cache
+            self._started[name] = started or time.time()
+
+    def names(self):
+        with self._lock:
+            return list(self._caches)
+
+    def stats(self, footprint=True):
+        """
+        Get the statistics of all caches.
+
+        :param footprint: also estimate the memory footprint of the caches
+        :return: ordered dict mapping cache names to their statistics
+        """
+        with self._lock:
+            caches = list(self._caches.items())
+            started = dict(self._started)
+        now = time.time()
+        report = OrderedDict()
+        for name, cache in caches:
+            try:
+                stats = dict(cache.stats())
+            except Exception as e:
+                report[name] = {"error": str(e)}
+                continue
+            hits = stats.get("hits", 0) + stats.get("alias_hits", 0)
+            misses = stats.get("misses")
+            if misses is not None:
+                lookups = hits + misses
+                stats["hit_rate"] = round(hits / float(lookups), 3) if lookups else None
+            if "evictions" in stats and stats.get("misses"):
+                stats["eviction_rate"] = round(
+                    stats["evictions"] / float(stats["misses"]), 3
+                )
+            if footprint and "bytes" not in stats:
+                try:
+                    stats["bytes"] = estimate_size(cache, self._exclude)
+                except RuntimeError:  # changed while it was walked
+                    stats["bytes"] = None
+            stats["age"] = round(now - started[name], 1)
+            report[name] = stats
+        return report
+
+    def flush(self, root=None):
+        """
+        Flush all caches, or their entries for a library root or title folder.
+
+        :param root: (Optional) the folder to flush, everything if None
+        :return: ordered dict mapping cache names to the number of dropped
+            entries
+        """
+        with self._lock:
+            caches = list(self._caches.items())
+        result = OrderedDict()
+        for name, cache in caches:
+            discard = getattr(cache, "discard", None)
+            if discard is None:
+                continue
+            result[name] = discard(root)
+            if root is None:
+                with self._lock:
+                    self._started[name] = time.time()
+        log.info(
+            "Flushed caches{root}: {result}".format(
+                root=" for {root!r}".format(root=root) if root else "",
+                result=", ".join(
+                    "{name} {number}".format(name=n, number=c)
+                    for n, c in result.items()
+                ),
+            )
+        )
+        return result
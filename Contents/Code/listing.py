@@ -0,0 +1,146 @@
+# coding=utf-8
+
+"""
+Cached folder listings.
+
+A title folder is listed once and the listing is shared by everything that
+looks for files in it: the subtitle search, the local extras and the first
+.nfo fallback. Listings are validated by the folder's modification time,
+which changes whenever an entry is added, removed or renamed, so a cached
+listing costs a single stat.
+"""
+
+import os
+
+from __init__ import log
+from lru import LRUCache
+
+# Number of folder listings kept in memory.
+LISTING_LIMIT = 2000
+
+
+class FolderListing(object):
+    """
+    Names of the entries of a folder, sorted.
+
+    The files and subfolders are told apart on first use. os.scandir gets the
+    entry types from the directory itself; without it every entry costs a
+    stat, which lookups that only match names, like the first .nfo fallback,
+    avoid by using names and is_file.
+    """
+
+    __slots__ = ("path", "mtime", "names", "_files", "_folders")
+
+    def __init__(self, path, mtime, names, files=None, folders=None):
+        self.path = path
+        self.mtime = mtime
+        self.names = names
+        self._files = files
+        self._folders = folders
+
+    def _classify(self):
+        files = []
+        folders = []
+        for name in self.names:
+            path = os.path.join(self.path, name)
+            if os.path.isfile(path):
+                files.append(name)
+            elif os.path.isdir(path):
+                folders.append(name)
+        # concurrent callers classify the same names, either result is kept
+        self._files, self._folders = tuple(files), tuple(folders)
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._classify()
+        return self._files
+
+    @property
+    def folders(self):
+        if self._folders is None:
+            self._classify()
+        return self._folders
+
+    def is_file(self, name):
+        """
+        :param name: name of an entry of the folder
+        :return: True if the entry is a file, without classifying the others
+        """
+        if self._files is not None:
+            return name in self._files
+        return os.path.isfile(os.path.join(self.path, name))
+
+
+def list_folder(folder_path, mtime):
+    """
+    List a folder.
+
+    os.scandir gets the entry types from the directory itself where it is
+    available, so files and subfolders are told apart right away. Otherwise
+    only the names are listed and the entries are checked when the files or
+    subfolders are first needed.
+
+    :param folder_path: the folder to list
+    :param mtime: the modification time of the folder
+    :return: a FolderListing
+    """
+    scandir = getattr(os, "scandir", None)
+    if scandir is None:  # Python 2
+        return FolderListing(folder_path, mtime, tuple(sorted(os.listdir(folder_path))))
+    names = []
+    files = []
+    folders = []
+    for entry in scandir(folder_path):
+        names.append(entry.name)
+        try:
+            if entry.is_file():
+                files.append(entry.name)
+            elif entry.is_dir():
+                folders.append(entry.name)
+        except OSError:
+            continue
+    return FolderListing(
+        folder_path,
+        mtime,
+        tuple(sorted(names)),
+        tuple(sorted(files)),
+        tuple(sorted(folders)),
+    )
+
+
+class FolderListings(LRUCache):
+    """
+    LRU cache of folder listings, validated by the folder's mtime.
+    """
+
+    def __init__(self, limit=LISTING_LIMIT):
+        super(FolderListings, self).__init__(limit)
+
+    def get(self, folder_path):
+        """
+        Get the listing of a folder.
+
+        :param folder_path: the folder to list
+        :return: a FolderListing or None if the folder can't be listed
+        """
+        try:
+            mtime = os.stat(folder_path).st_mtime
+        except OSError:
+            return None
+        listing = self.lookup(folder_path, lambda listing: listing.mtime == mtime)
+        if listing is not None:
+            return listing
+        try:
+            listing = list_folder(folder_path, mtime)
+        except OSError as e:
+            log.debug(
+                "Unable to list {path!r}: {error}".format(path=folder_path, error=e)
+            )
+            return None
+        self.put(folder_path, listing)
+        return listing
+
+
+folder_listings = FolderListings()
+get_folder_listing = folder_listings.get
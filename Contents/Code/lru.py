@@ -0,0 +1,150 @@
+# coding=utf-8
+
+"""
+Least recently used cache shared by the agent's in-memory caches.
+
+Entries are kept in an OrderedDict in order of use and the least recently
+used ones are evicted once the total weight of the entries exceeds the
+limit. Every entry weighs 1 unless a weigh function is given, so the limit is
+a number of entries by default. Keys are paths, or have a path that
+discard(root) flushes them by.
+
+Subclasses validate entries on lookup, e.g. by the mtime of a file, and may
+use the lock, _find and _store to update entries atomically.
+"""
+
+import threading
+from collections import OrderedDict
+
+from __init__ import is_below
+
+
+class LRUCache(object):
+    """
+    Thread safe LRU cache with hit and miss counters.
+
+    :param limit: maximum total weight of the entries, or a callable
+        returning it
+    :param weigh: (Optional) callable returning the weight of a value,
+        defaults to 1
+    """
+
+    def __init__(self, limit, weigh=None):
+        self._limit = limit
+        self._weigh = weigh or (lambda value: 1)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def limit(self):
+        return self._limit() if callable(self._limit) else self._limit
+
+    def _find(self, key, valid=None):
+        """
+        Get a valid entry and mark it as recently used. Call with the lock.
+
+        :param key: the key of the entry
+        :param valid: (Optional) callable telling whether a value is current,
+            invalid entries are kept until they are replaced
+        :return: the value or None
+        """
+        value = self._entries.get(key)
+        if value is None or (valid is not None and not valid(value)):
+            return None
+        self._entries[key] = self._entries.pop(key)
+        return value
+
+    def _store(self, key, value):
+        """
+        Store an entry, evicting the least recently used ones beyond the
+        limit. Call with the lock.
+        """
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._weight -= self._weigh(old)
+        self._entries[key] = value
+        self._weight += self._weigh(value)
+        limit = self.limit
+        while self._weight > limit and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._weight -= self._weigh(evicted)
+            self.evictions += 1
+
+    def _remove(self, key):
+        """
+        Remove an entry if it exists. Call with the lock.
+        """
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._weight -= self._weigh(value)
+
+    @staticmethod
+    def path_of(key, value):
+        """
+        :return: the path an entry is flushed by, its key by default
+        """
+        return key
+
+    def lookup(self, key, valid=None):
+        """
+        Get a cached value, counting a hit or a miss.
+
+        :param key: the key of the entry
+        :param valid: (Optional) callable telling whether a value is current
+        :return: the value or None
+        """
+        with self._lock:
+            value = self._find(key, valid)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Cache a value.
+
+        :param key: the key of the entry
+        :param value: the value, not None
+        """
+        with self._lock:
+            self._store(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+
+    def discard(self, root=None):
+        """
+        Forget the entries of the paths inside a folder.
+
+        :param root: (Optional) the folder, all entries if None
+        :return: number of forgotten entries
+        """
+        with self._lock:
+            keys = [
+                key
+                for key, value in self._entries.items()
+                if is_below(self.path_of(key, value), root)
+            ]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def stats(self):
+        """
+        :return: dict with the number of entries, hits, misses and evictions
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
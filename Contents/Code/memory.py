@@ -0,0 +1,303 @@
+# coding=utf-8
+
+"""
+Opt-in memory accounting for the agent's entry points.
+
+When the memprofile preference is set, every instrumented call records the
+peak and retained memory of its phase for the title it worked on. A report of
+the phases, the titles that retained the most and the top allocators is
+written to the plugin's data directory every memreportevery titles.
+
+tracemalloc and the resident set size are process wide, so instrumented calls
+are run one at a time while the preference is set. Otherwise the numbers of a
+title would include the allocations of titles updated concurrently.
+
+tracemalloc is used when it is available. Otherwise the process' resident
+set size is sampled, which only allows coarse, process wide numbers, and the
+top allocators are replaced by the most common object types.
+"""
+
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from __init__ import data_path
+from __init__ import log
+from __init__ import preferences
+
+REPORT_NAME = "memory_report.txt"
+# Phase whose calls are counted as titles for the report interval.
+TITLE_PHASE = "update"
+# Number of titles kept for the report.
+TITLE_LIMIT = 1000
+# Number of lines in the top allocator section of the report.
+TOP_LIMIT = 25
+# Number of stack frames recorded per allocation.
+TRACE_FRAMES = 5
+
+# Imported by the first recorded call, see import_tracing.
+tracemalloc = None
+resource = None
+tracing_imported = False
+
+
+def import_tracing():
+    """
+    Import tracemalloc and resource where they are available.
+
+    They are only needed while the memprofile preference is set, so they are
+    not imported with the plugin.
+    """
+    global tracemalloc, resource, tracing_imported
+    if tracing_imported:
+        return
+    try:
+        import tracemalloc
+    except ImportError:  # Python 2
+        tracemalloc = None
+    try:
+        import resource
+    except ImportError:  # Windows
+        resource = None
+    tracing_imported = True
+
+
+def get_rss():
+    """
+    :return: the current resident set size in bytes or None
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (EnvironmentError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def get_max_rss():
+    """
+    :return: the peak resident set size in bytes or None
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if os.uname()[0] == "Darwin" else max_rss * 1024
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return "{size:.1f} {unit}".format(size=size, unit=unit)
+        size /= 1024.0
+    return "{size:.1f} GiB".format(size=size)
+
+
+class MemoryTracker(object):
+    """
+    Records peak and retained bytes per title and phase.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # held by the outermost instrumented call while profiling
+        self._serial = threading.Lock()
+        self._local = threading.local()
+        self._titles = OrderedDict()
+        self._phases = {}
+        self._started = False
+        self._count = 0
+
+    @staticmethod
+    def enabled():
+        try:
+            return bool(preferences["memprofile"])
+        except KeyError:
+            return False
+
+    @staticmethod
+    def report_every():
+        try:
+            return max(int(preferences["memreportevery"] or 0), 0)
+        except (KeyError, TypeError, ValueError):
+            return 0
+
+    def _start(self):
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            self._started = True
+
+    def _stop(self):
+        if self._started and tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started = False
+
+    def _sample(self, outermost):
+        if tracemalloc:
+            if outermost and hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            return tracemalloc.get_traced_memory()
+        rss = get_rss() or 0
+        return rss, get_max_rss() or rss
+
+    def call(self, phase, title, function, *args, **kwargs):
+        """
+        Call a function and record its memory use.
+
+        :param phase: name of the phase
+        :param title: the title the call works on
+        :param function: the function to call
+        :return: the function's return value
+        """
+        if not self.enabled():
+            self._stop()
+            return function(*args, **kwargs)
+        import_tracing()
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            self._serial.acquire()
+        try:
+            self._start()
+            self._local.depth = depth + 1
+            before, before_peak = self._sample(depth == 0)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._local.depth = depth
+                after, peak = self._sample(False)
+                if not tracemalloc and peak <= before_peak:
+                    peak = max(after, before)  # the process peak was not raised
+                self.record(phase, title, max(peak - before, 0), after - before)
+        finally:
+            if depth == 0:
+                self._serial.release()
+                if phase == TITLE_PHASE:
+                    self._title_done()
+
+    def record(self, phase, title, peak, retained):
+        with self._lock:
+            phases = self._titles.pop(title, None) or {}
+            phases[phase] = (peak, retained)
+            self._titles[title] = phases
+            while len(self._titles) > TITLE_LIMIT:
+                self._titles.popitem(last=False)
+            calls, total_peak, max_peak, total_retained = self._phases.get(
+                phase, (0, 0, 0, 0)
+            )
+            self._phases[phase] = (
+                calls + 1,
+                total_peak + peak,
+                max(max_peak, peak),
+                total_retained + retained,
+            )
+        log.debug(
+            "Memory {phase} {title}: peak {peak}, retained {retained}".format(
+                phase=phase,
+                title=title,
+                peak=format_size(peak),
+                retained=format_size(retained),
+            )
+        )
+
+    def _title_done(self):
+        every = self.report_every()
+        with self._lock:
+            self._count += 1
+            write = every and self._count % every == 0
+        if write:
+            self.write_report()
+
+    def top_allocators(self):
+        """
+        :return: list of report lines describing the top allocators
+        """
+        if tracemalloc and tracemalloc.is_tracing():
+            statistics = tracemalloc.take_snapshot().statistics("lineno")
+            return [str(statistic) for statistic in statistics[:TOP_LIMIT]]
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        ranked = sorted(counts.items(), key=lambda item: -item[1])[:TOP_LIMIT]
+        return ["{count:>10} {name}".format(count=c, name=n) for n, c in ranked]
+
+    def report(self):
+        """
+        :return: the report as text
+        """
+        with self._lock:
+            phases = dict(self._phases)
+            titles = list(self._titles.items())
+            count = self._count
+        lines = [
+            "Memory report {time} after {count} titles ({mode}, titles are"
+            " processed one at a time while recording)".format(
+                time=time.strftime("%Y-%m-%d %H:%M:%S"),
+                count=count,
+                mode="tracemalloc" if tracemalloc else "resident set size",
+            ),
+            "",
+            "Phases (calls, average peak, max peak, retained):",
+        ]
+        for phase in sorted(phases):
+            calls, total_peak, max_peak, total_retained = phases[phase]
+            lines.append(
+                "  {phase}: {calls}, {average}, {max}, {retained}".format(
+                    phase=phase,
+                    calls=calls,
+                    average=format_size(total_peak // calls),
+                    max=format_size(max_peak),
+                    retained=format_size(total_retained),
+                )
+            )
+        lines.extend(["", "Titles retaining the most memory:"])
+        ranked = sorted(titles, key=lambda item: -sum(r for _, r in item[1].values()))[
+            :TOP_LIMIT
+        ]
+        for title, title_phases in ranked:
+            lines.append("  {title}".format(title=title))
+            for phase in sorted(title_phases):
+                peak, retained = title_phases[phase]
+                lines.append(
+                    "    {phase}: peak {peak}, retained {retained}".format(
+                        phase=phase,
+                        peak=format_size(peak),
+                        retained=format_size(retained),
+                    )
+                )
+        lines.extend(["", "Top allocators:"])
+        lines.extend("  " + line for line in self.top_allocators())
+        return "\n".join(lines) + "\n"
+
+    def write_report(self):
+        """
+        Write the report to the plugin's data directory.
+        """
+        path = os.path.join(data_path, REPORT_NAME)
+        try:
+            report = self.report()
+            with open(path, "wb") as report_file:
+                report_file.write(
+                    report if isinstance(report, bytes) else report.encode("utf-8")
+                )
+            log.info("Memory report written to {path}".format(path=path))
+        except Exception as e:
+            log.error("Unable to write memory report: {error}".format(error=e))
+
+    def stats(self):
+        """
+        :return: dict with the number of tracked titles and phases, and
+            whether tracemalloc is used once recording started
+        """
+        with self._lock:
+            return {
+                "titles": len(self._titles),
+                "phases": dict(
+                    (phase, values[0]) for phase, values in self._phases.items()
+                ),
+                "tracemalloc": bool(tracemalloc),
+            }
+
+
+memory_tracker = MemoryTracker()
@@ -0,0 +1,374 @@
+# coding=utf-8
+
+"""
+Encoding detection and parse failure bookkeeping for .nfo files.
+
+Nfo files are written by many tools: most are utf-8, but utf-16 files with a
+byte order mark and cp1252 files from Windows tools are common. The encoding
+is detected once, from the byte order mark, the XML declaration or a bounded
+look at the content, and the file is decoded before it is parsed, so the
+parser is never run on bytes it cannot read.
+
+Nfo files that still can't be parsed are remembered with their modification
+time and size, and skipped until they change.
+
+Search only needs a few identity fields, which are usually at the start of
+the file. scan_identity reads the file in small chunks and stops as soon as
+they were found, so large scraped nfos are neither read nor parsed fully.
+"""
+
+import codecs
+import os
+import re
+import sys
+import threading
+
+from __init__ import LazyRegex
+from __init__ import is_below
+from __init__ import log
+from __init__ import persistent_dict
+
+PY2 = sys.version_info[0] == 2
+if not PY2:
+    unichr = chr
+
+# Byte order marks, the utf-32 ones first as they start with the utf-16 ones.
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+XML_DECLARATION_REGEX = LazyRegex(b"^\\s*<\\?xml[^>]*?\\?>")
+XML_ENCODING_REGEX = LazyRegex(b"encoding\\s*=\\s*[\"']([A-Za-z0-9._-]+)[\"']")
+# Number of bytes checked for valid utf-8 before falling back to cp1252.
+SNIFF_SIZE = 64 * 1024
+FALLBACK_ENCODING = "cp1252"
+
+# Fields read by scan_identity.
+IDENTITY_FIELDS = ("title", "sorttitle", "year", "tmdbid")
+SCAN_CHUNK_SIZE = 4096
+# Bytes at the end of a file looked at for the end of the <movie> root.
+TAIL_SIZE = 4096
+TOKEN_REGEX = LazyRegex(
+    r"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<!(?!--|\[CDATA\[)[^>]*>"
+    r"|<(?P<close>/?)(?P<tag>[A-Za-z_][\w.:-]*)(?:\s[^>]*?)?(?P<empty>/?)>",
+    re.DOTALL,
+)
+ENTITY_REGEX = LazyRegex(r"&(#x[0-9a-fA-F]+|#[0-9]+|[A-Za-z]+[0-9]*);")
+# Inserted by the decoder for bytes that are invalid in the encoding.
+REPLACEMENT_CHARACTER = unichr(0xFFFD)
+XML_ENTITIES = {"amp": "&", "lt": "<", "gt": ">", "quot": '"', "apos": "'"}
+
+FAILURES_KEY = "nfo_failures"
+# Maximum number of remembered parse failures.
+FAILURE_LIMIT = 5000
+
+
+def get_codec(name):
+    """
+    :return: the normalized name of a codec or None if it is unknown
+    """
+    try:
+        return codecs.lookup(name.decode("ascii")).name
+    except (LookupError, UnicodeDecodeError):
+        return None
+
+
+def is_utf8(data):
+    """
+    Check whether the first SNIFF_SIZE bytes are valid utf-8.
+
+    A sequence cut off at the end of the checked range is accepted.
+    """
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(data[:SNIFF_SIZE], False)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def detect_encoding(data):
+    """
+    Detect the encoding of an nfo file.
+
+    :param data: the content of the file
+    :return: tuple (encoding, bom length)
+    """
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding, len(bom)
+    # utf-16 without byte order mark
+    if data[:2] == b"<\x00":
+        return "utf-16-le", 0
+    if data[:2] == b"\x00<":
+        return "utf-16-be", 0
+    declaration = XML_DECLARATION_REGEX.match(data)
+    if declaration:
+        encoding = XML_ENCODING_REGEX.search(declaration.group(0))
+        codec = encoding and get_codec(encoding.group(1))
+        if codec and not codec.startswith("utf-16") and codec != "utf-8":
+            return codec, 0
+    return ("utf-8" if is_utf8(data) else FALLBACK_ENCODING), 0
+
+
+def decode_nfo(data):
+    """
+    Decode the content of an nfo file for parsing.
+
+    utf-8 content is returned as it is. Anything else is decoded and encoded
+    to utf-8, without byte order mark and XML declaration, so the parser reads
+    it the same way.
+
+    :param data: the content of the file
+    :return: the content as str
+    """
+    if not isinstance(data, bytes):
+        return data
+    encoding, bom = detect_encoding(data)
+    if encoding == "utf-8" and not bom and PY2:
+        return data
+    if encoding != "utf-8":
+        log.debug("Decoding nfo as {encoding}".format(encoding=encoding))
+    text = data[bom:].decode(encoding, "replace")
+    # the declaration no longer matches the content
+    text = XML_DECLARATION_REGEX.sub(b"", text.encode("utf-8"), count=1)
+    return text if PY2 else text.decode("utf-8")
+
+
+def unescape_xml(text):
+    """
+    Replace the predefined XML entities and character references.
+
+    Other entities are an error for the XML parser, so they raise a KeyError.
+    Stray ampersands are kept, like the sanitized full parse does.
+    """
+
+    def replace(match):
+        name = match.group(1)
+        if name.startswith("#x"):
+            return unichr(int(name[2:], 16))
+        if name.startswith("#"):
+            return unichr(int(name[1:]))
+        return XML_ENTITIES[name]
+
+    return ENTITY_REGEX.sub(replace, text) if "&" in text else text
+
+
+def iter_text(nfo_file):
+    """
+    Read and decode an nfo file in chunks.
+
+    :param nfo_file: the nfo file
+    :return: iterator of decoded text chunks
+    """
+    with open(nfo_file, "rb") as nfo:
+        data = nfo.read(SCAN_CHUNK_SIZE)
+        encoding, bom = detect_encoding(data)
+        decoder = codecs.getincrementaldecoder(encoding)("replace")
+        data = data[bom:]
+        while data:
+            yield decoder.decode(data)
+            data = nfo.read(SCAN_CHUNK_SIZE)
+        yield decoder.decode(b"", True)
+
+
+def closes_root(nfo_file):
+    """
+    Check whether the end of an nfo file closes the <movie> root.
+
+    The full parse rejects files without a closing </movie> tag and ignores
+    anything after it, so a truncated file is caught here as long as the text
+    after the tag fits into the last TAIL_SIZE bytes.
+
+    :param nfo_file: the nfo file
+    :return: True if the tag is found
+    """
+    with open(nfo_file, "rb") as nfo:
+        encoding, _ = detect_encoding(nfo.read(SCAN_CHUNK_SIZE))
+        nfo.seek(0, os.SEEK_END)
+        nfo.seek(max(nfo.tell() - TAIL_SIZE, 0))
+        tail = nfo.read()
+    return "</movie>".encode(encoding) in tail.lower()
+
+
+def scan_identity(nfo_file):
+    """
+    Scan an nfo file for the fields search needs.
+
+    Only the direct children of the <movie> root are looked at. The scan stops
+    when all IDENTITY_FIELDS were found or the <movie> element ends. Anything
+    the scan can't read the same way the full parse would, gives up, and so
+    does a scan that stopped early in a file whose root is never closed.
+
+    :param nfo_file: the nfo file
+    :return: dict with the texts of the found fields or None if the file has
+        to be parsed fully
+    """
+    found = {}
+    depth = 0
+    field = None  # (tag, start) of the field being read
+    text = ""
+    pos = 0
+    try:
+        for chunk in iter_text(nfo_file):
+            keep = field[1] if field else pos
+            text = text[keep:] + chunk
+            pos -= keep
+            if field:
+                field = (field[0], 0)
+            while True:
+                start = text.find("<", pos)
+                if start < 0:
+                    if depth == 0 and text[pos:].strip():
+                        return None
+                    pos = len(text)
+                    break
+                if depth == 0 and text[pos:start].strip():
+                    return None
+                match = TOKEN_REGEX.match(text, start)
+                if match is None:
+                    pos = start
+                    break  # incomplete token, read on
+                pos = match.end()
+                tag = match.group("tag")
+                if tag is None:
+                    if field:
+                        return None  # comment or CDATA inside a field
+                elif match.group("close"):
+                    if field:
+                        if tag != field[0]:
+                            return None
+                        value = unescape_xml(text[field[1] : match.start()])
+                        if REPLACEMENT_CHARACTER in value:
+                            return None  # not decoded the way the parse does
+                        if value.strip():
+                            found[tag] = value
+                        field = None
+                        if len(found) == len(IDENTITY_FIELDS):
+                            return found if closes_root(nfo_file) else None
+                    elif depth == 1:
+                        return found if tag == "movie" else None
+                    depth -= 1
+                elif depth == 0:
+                    if tag != "movie" or match.group("empty"):
+                        return None
+                    depth = 1
+                elif field:
+                    return None  # element inside a field
+                elif match.group("empty"):
+                    continue
+                else:
+                    if depth == 1 and tag in IDENTITY_FIELDS and tag not in found:
+                        field = (tag, pos)
+                    depth += 1
+    except (EnvironmentError, LookupError, OverflowError, ValueError) as e:
+        log.debug("Unable to scan {nfo}: {error}".format(nfo=nfo_file, error=e))
+    return None
+
+
+class ParseFailures(object):
+    """
+    Nfo files that could not be parsed, by path, with their mtime and size.
+    """
+
+    def __init__(self, store, key):
+        self._store = store
+        self._key = key
+        self._lock = threading.Lock()
+        self._failures = None
+        self.skipped = 0
+
+    def _load(self):
+        if self._failures is None:
+            try:
+                self._failures = dict(self._store[self._key])
+            except (KeyError, TypeError, ValueError):
+                self._failures = {}
+        return self._failures
+
+    def _save(self):
+        try:
+            self._store[self._key] = self._failures
+            self._store.Save()
+        except Exception as e:
+            log.debug("Unable to save nfo failures: {error}".format(error=e))
+
+    def is_failed(self, nfo_file):
+        """
+        Check whether an nfo file failed to parse and has not changed since.
+
+        :param nfo_file: the nfo file
+        :return: True if the file should be skipped
+        """
+        with self._lock:
+            failure = self._load().get(nfo_file)
+        if failure is None:
+            return False
+        try:
+            stat = os.stat(nfo_file)
+        except OSError:
+            return False
+        if tuple(failure) != (stat.st_mtime, stat.st_size):
+            self.clear(nfo_file)
+            return False
+        self.skipped += 1
+        return True
+
+    def add(self, nfo_file):
+        """
+        Remember that an nfo file could not be parsed.
+
+        :param nfo_file: the nfo file
+        """
+        try:
+            stat = os.stat(nfo_file)
+        except OSError:
+            return
+        with self._lock:
+            failures = self._load()
+            if len(failures) >= FAILURE_LIMIT:
+                failures.clear()
+            failures[nfo_file] = (stat.st_mtime, stat.st_size)
+            self._save()
+
+    def clear(self, nfo_file=None):
+        """
+        Forget the failure of an nfo file, or all failures.
+
+        :param nfo_file: (Optional) the nfo file
+        """
+        with self._lock:
+            failures = self._load()
+            if nfo_file is None:
+                failures.clear()
+            elif failures.pop(nfo_file, None) is None:
+                return
+            self._save()
+
+    def discard(self, root=None):
+        """
+        Forget the failures of the nfo files inside a folder.
+
+        :param root: (Optional) the folder, all failures if None
+        :return: number of forgotten failures
+        """
+        with self._lock:
+            failures = self._load()
+            nfo_files = [f for f in failures if is_below(f, root)]
+            for nfo_file in nfo_files:
+                del failures[nfo_file]
+            if nfo_files:
+                self._save()
+        return len(nfo_files)
+
+    def stats(self):
+        """
+        :return: dict with the number of failures and skipped parses
+        """
+        with self._lock:
+            return {"entries": len(self._load()), "skipped": self.skipped}
+
+
+parse_failures = ParseFailures(persistent_dict, FAILURES_KEY)
@@ -0,0 +1,207 @@
+# coding=utf-8
+
+"""
+Opt-in call profiling for the agent's entry points.
+
+When the profile preference is set, every profileevery-th call of each
+instrumented phase (search, update, subtitles) runs under cProfile. Nested
+instrumented calls are part of the outer call's profile. The profiles are
+aggregated per phase and, every REPORT_INTERVAL profiled calls, appended to a
+report in the plugin's data directory, sorted by cumulative time. The report
+is rotated once it grows beyond REPORT_SIZE, keeping REPORT_BACKUPS old
+reports. The profiling modules are only imported once a call is profiled.
+"""
+
+import os
+import threading
+import time
+
+try:
+    from cStringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+from __init__ import data_path
+from __init__ import log
+from __init__ import preferences
+
+REPORT_NAME = "profile_report.txt"
+REPORT_SIZE = 1024 * 1024
+REPORT_BACKUPS = 3
+# Number of profiled calls between two reports.
+REPORT_INTERVAL = 10
+# Number of functions listed per phase in the report.
+TOP_LIMIT = 40
+
+
+def import_profiling():
+    """
+    :return: tuple of the profile module, cProfile where available, and
+        pstats
+    """
+    try:
+        import cProfile as profile
+    except ImportError:
+        import profile
+    import pstats
+
+    return profile, pstats
+
+
+class CallProfiler(object):
+    """
+    Profiles every Nth call of each phase and aggregates the results.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._calls = {}
+        self._profiled = {}
+        self._stats = {}
+        self._count = 0
+        self.skipped = 0
+
+    @staticmethod
+    def enabled():
+        try:
+            return bool(preferences["profile"])
+        except KeyError:
+            return False
+
+    @staticmethod
+    def sample_every():
+        try:
+            return max(int(preferences["profileevery"] or 1), 1)
+        except (KeyError, TypeError, ValueError):
+            return 1
+
+    def _sampled(self, phase):
+        every = self.sample_every()
+        with self._lock:
+            calls = self._calls.get(phase, 0) + 1
+            self._calls[phase] = calls
+            return calls % every == 0
+
+    def call(self, phase, function, *args, **kwargs):
+        """
+        Call a function, profiling it if the call is sampled.
+
+        :param phase: name of the phase
+        :param function: the function to call
+        :return: the function's return value
+        """
+        if getattr(self._local, "active", False) or not self.enabled():
+            return function(*args, **kwargs)
+        if not self._sampled(phase):
+            return function(*args, **kwargs)
+        profile, _ = import_profiling()
+        profiler = profile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # another profiler is active in this process
+            with self._lock:
+                self.skipped += 1
+            return function(*args, **kwargs)
+        self._local.active = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.disable()
+            self._local.active = False
+            self.record(phase, profiler)
+
+    def record(self, phase, profiler):
+        _, pstats = import_profiling()
+        with self._lock:
+            stats = self._stats.get(phase)
+            try:
+                if stats is None:
+                    self._stats[phase] = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+            except TypeError:  # nothing was recorded
+                return
+            self._profiled[phase] = self._profiled.get(phase, 0) + 1
+            self._count += 1
+            write = self._count % REPORT_INTERVAL == 0
+        if write:
+            self.write_report()
+
+    def report(self):
+        """
+        :return: the report as text
+        """
+        with self._lock:
+            lines = [
+                "Profile report {time} after {count} profiled calls".format(
+                    time=time.strftime("%Y-%m-%d %H:%M:%S"), count=self._count
+                )
+            ]
+            for phase in sorted(self._stats):
+                lines.extend(
+                    [
+                        "",
+                        "{phase}: {profiled} of {calls} calls profiled".format(
+                            phase=phase,
+                            profiled=self._profiled[phase],
+                            calls=self._calls.get(phase, 0),
+                        ),
+                    ]
+                )
+                output = StringIO()
+                stats = self._stats[phase]
+                stats.stream = output
+                stats.sort_stats("cumulative").print_stats(TOP_LIMIT)
+                lines.append(output.getvalue())
+        return "\n".join(lines) + "\n"
+
+    def write_report(self):
+        """
+        Append the report to the plugin's data directory, rotating it.
+        """
+        path = os.path.join(data_path, REPORT_NAME)
+        try:
+            report = self.report()
+            if os.path.exists(path) and os.path.getsize(path) >= REPORT_SIZE:
+                rotate(path, REPORT_BACKUPS)
+            with open(path, "ab") as report_file:
+                report_file.write(
+                    report if isinstance(report, bytes) else report.encode("utf-8")
+                )
+            log.info("Profile report written to {path}".format(path=path))
+        except Exception as e:
+            log.error("Unable to write profile report: {error}".format(error=e))
+
+    def stats(self):
+        """
+        :return: dict with the number of calls and profiled calls per phase
+        """
+        with self._lock:
+            return {
+                "enabled": self.enabled(),
+                "calls": dict(self._calls),
+                "profiled": dict(self._profiled),
+                "skipped": self.skipped,
+            }
+
+
+def rotate(path, backups):
+    """
+    Rotate a file to path.1, path.1 to path.2 and so on, dropping the oldest.
+
+    :param path: the file to rotate
+    :param backups: number of old files to keep
+    """
+    names = [path] + [
+        "{path}.{number}".format(path=path, number=number)
+        for number in range(1, backups + 1)
+    ]
+    if os.path.exists(names[-1]):
+        os.remove(names[-1])
+    for source, target in reversed(list(zip(names, names[1:]))):
+        if os.path.exists(source):
+            os.rename(source, target)
+
+
+call_profiler = CallProfiler()
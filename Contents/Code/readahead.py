@@ -0,0 +1,159 @@
+# coding=utf-8
+
+"""
+Read scheduling for cold caches.
+
+update reads up to three files per title: the nfo, the poster and the fanart.
+Read one after the other, interleaved with parsing, they cost a seek each on
+spinning disks. The files of a title are resolved first and hinted to the
+kernel with posix_fadvise WILLNEED in inode order, so they are fetched in a
+single sweep while the nfo is being parsed. Files are read in a single call,
+which sizes the buffer from the file's size, with a sequential access hint.
+
+Python 2 has no os.posix_fadvise, the C library's is called through ctypes
+on Linux instead. It is looked up on the first read, not at startup.
+Elsewhere, e.g. on Windows, hints are skipped.
+"""
+
+import os
+import sys
+import threading
+
+# Linux values, for the C library's posix_fadvise on Python 2
+POSIX_FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", 2)
+POSIX_FADV_WILLNEED = getattr(os, "POSIX_FADV_WILLNEED", 3)
+POSIX_FADV_DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", 4)
+
+
+def load_libc_fadvise():
+    """
+    Get posix_fadvise from the C library.
+
+    :return: a function with the signature of os.posix_fadvise or None if it
+        is not available
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+
+        # the C library is already loaded into the process, which avoids
+        # ctypes.util.find_library running ldconfig
+        libc = ctypes.CDLL(None)
+        # posix_fadvise64 takes 64 bit offsets on 32 bit systems as well
+        function = getattr(libc, "posix_fadvise64", None)
+        if function is None:
+            function = libc.posix_fadvise
+            offset_type = ctypes.c_long
+        else:
+            offset_type = ctypes.c_int64
+    except (ImportError, OSError, AttributeError):
+        return None
+    function.argtypes = (ctypes.c_int, offset_type, offset_type, ctypes.c_int)
+    function.restype = ctypes.c_int
+
+    def fadvise(fd, offset, length, advice):
+        # returns the error number instead of setting errno
+        error = function(fd, offset, length, advice)
+        if error:
+            raise OSError(error, os.strerror(error))
+
+    return fadvise
+
+
+# posix_fadvise or None, once get_fadvise looked it up
+fadvise = None
+fadvise_resolved = False
+
+
+def get_fadvise():
+    """
+    :return: posix_fadvise or None if it is not available
+    """
+    global fadvise, fadvise_resolved
+    if not fadvise_resolved:
+        fadvise = getattr(os, "posix_fadvise", None) or load_libc_fadvise()
+        fadvise_resolved = True
+    return fadvise
+
+
+class ReadScheduler(object):
+    """
+    Issues readahead hints and reads files.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hinted = 0
+        self.reads = 0
+        self.bytes_read = 0
+
+    def prefetch(self, paths):
+        """
+        Hint the kernel to read files ahead, in inode order.
+
+        :param paths: files that are about to be read, None entries are skipped
+        :return: number of hinted files
+        """
+        fadvise = get_fadvise()
+        if fadvise is None:
+            return 0
+        files = []
+        for path in set(paths):
+            if not path:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_dev, stat.st_ino, stat.st_size, path))
+        files.sort()
+        for _, _, size, path in files:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    fadvise(fd, 0, size, POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            except OSError:
+                continue
+        with self._lock:
+            self.hinted += len(files)
+        return len(files)
+
+    def read(self, path):
+        """
+        Read a file with a sequential access hint.
+
+        :param path: the file to read
+        :return: the content of the file
+        """
+        fadvise = get_fadvise()
+        with open(path, "rb") as data_file:
+            if fadvise is not None:
+                try:
+                    fadvise(data_file.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    pass
+            data = data_file.read()
+        with self._lock:
+            self.reads += 1
+            self.bytes_read += len(data)
+        return data
+
+    def stats(self):
+        """
+        :return: dict with the number of hinted files, reads and bytes read
+        """
+        with self._lock:
+            return {
+                "fadvise": get_fadvise() is not None,
+                "hinted": self.hinted,
+                "reads": self.reads,
+                "bytes_read": self.bytes_read,
+            }
+
+
+read_scheduler = ReadScheduler()
+prefetch = read_scheduler.prefetch
+read_file = read_scheduler.read
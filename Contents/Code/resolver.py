@@ -0,0 +1,540 @@
+# coding=utf-8
+
+"""
+Candidate resolution for NFO and artwork files.
+
+Every library layout tends to hit one naming pattern over and over again, so
+the resolver keeps hit counts per library root, file kind and pattern and
+probes the most successful candidates first.
+
+The candidates of a media file only depend on its path, so they are computed
+once into an immutable PathPlan that search, update and the subtitle search
+share. Media files inside a disc structure (VIDEO_TS, BDMV) are resolved
+against the title folder holding the structure.
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+from __init__ import RELATED_DIRS
+from __init__ import get_base_file
+from __init__ import get_movie_name_from_folder
+from __init__ import get_related_files
+from __init__ import is_below
+from __init__ import log
+from __init__ import persistent_dict
+from __init__ import replace_jpg_png
+from discs import get_disc_layout
+from listing import get_folder_listing
+from lru import LRUCache
+
+HIT_STATS_KEY = "candidate_hits"
+# Counts of a file kind are halved once they reach this total, so a library
+# that changes its layout is picked up again after a while.
+HIT_STATS_LIMIT = 1000
+# Number of recorded hits between two saves of the persistent dictionary.
+HIT_STATS_SAVE_INTERVAL = 25
+# Number of path plans kept in memory.
+PATH_PLAN_LIMIT = 5000
+# Number of folders known to miss a kind of file kept in memory.
+NEGATIVE_LIMIT = 5000
+# Candidates that do not depend on the movie's name, by pattern. They are
+# tried after the name specific candidates, whatever their hit counts, since
+# they also match files of other movies sharing the folder.
+FALLBACK_GROUPS = {"plain": 1, "movie": 1, "first_nfo": 2}
+
+
+class CandidateStats(object):
+    """
+    Persistent hit counts of candidate patterns.
+
+    Counts are kept as ``{library root: {kind: {pattern: hits}}}`` in the
+    plugin's persistent dictionary so they survive restarts.
+    """
+
+    def __init__(self, store, key):
+        self._store = store
+        self._key = key
+        self._lock = threading.Lock()
+        self._stats = None
+        self._unsaved = 0
+
+    def _load(self):
+        if self._stats is None:
+            stats = self._store[self._key] if self._key in self._store else None
+            self._stats = stats if isinstance(stats, dict) else {}
+        return self._stats
+
+    def hits(self, root, kind):
+        """
+        Get the hit counts recorded for a library root and file kind.
+
+        :param root: the library root
+        :param kind: the kind of file (nfo, poster, fanart)
+        :return: dict mapping patterns to hit counts
+        """
+        with self._lock:
+            return dict(self._load().get(root, {}).get(kind, {}))
+
+    def roots(self):
+        """
+        :return: list of library roots with recorded hits
+        """
+        with self._lock:
+            return list(self._load())
+
+    def order(self, root, kind, candidates):
+        """
+        Sort candidates by descending hit count.
+
+        Candidates are only reordered within their group: name specific
+        candidates first, then fixed names (movie.nfo, poster.jpg), then the
+        first .nfo in the folder. Candidates without hits keep their original
+        relative order.
+
+        :param root: the library root
+        :param kind: the kind of file (nfo, poster, fanart)
+        :param candidates: list of (pattern, path) tuples
+        :return: a new, sorted list of (pattern, path) tuples
+        """
+        hits = self.hits(root, kind)
+        ranked = sorted(
+            enumerate(candidates),
+            key=lambda item: (
+                FALLBACK_GROUPS.get(item[1][0].split(":")[0], 0),
+                -hits.get(item[1][0], 0),
+                item[0],
+            ),
+        )
+        return [candidate for _, candidate in ranked]
+
+    def record(self, root, kind, pattern):
+        """
+        Record a hit of a pattern.
+
+        :param root: the library root
+        :param kind: the kind of file (nfo, poster, fanart)
+        :param pattern: the pattern of the candidate that was found
+        """
+        with self._lock:
+            counts = self._load().setdefault(root, {}).setdefault(kind, {})
+            counts[pattern] = counts.get(pattern, 0) + 1
+            if sum(counts.values()) >= HIT_STATS_LIMIT:
+                for key in list(counts):
+                    counts[key] //= 2
+                    if not counts[key]:
+                        del counts[key]
+            self._unsaved += 1
+            save = self._unsaved >= HIT_STATS_SAVE_INTERVAL
+        if save:
+            self.save()
+
+    def save(self):
+        """
+        Write the hit counts to the persistent dictionary.
+        """
+        with self._lock:
+            self._store[self._key] = self._load()
+            self._unsaved = 0
+        self._store.Save()
+
+    def discard(self, root=None):
+        """
+        Forget the hit counts of the library roots inside a folder.
+
+        :param root: (Optional) the folder, all library roots if None
+        :return: number of forgotten library roots
+        """
+        with self._lock:
+            stats = self._load()
+            roots = [r for r in stats if is_below(r, root)]
+            for r in roots:
+                del stats[r]
+        if roots:
+            self.save()
+        return len(roots)
+
+    def stats(self):
+        """
+        :return: dict with the number of library roots and recorded hits
+        """
+        with self._lock:
+            stats = self._load()
+            return {
+                "entries": len(stats),
+                "hits": sum(
+                    sum(counts.values())
+                    for kinds in stats.values()
+                    for counts in kinds.values()
+                ),
+            }
+
+
+candidate_stats = CandidateStats(persistent_dict, HIT_STATS_KEY)
+
+
+class NegativeCache(LRUCache):
+    """
+    Remembers folders in which a kind of file could not be found.
+
+    Misses are remembered per search, the kind of file together with its
+    candidates, since the media files sharing a folder look for different
+    names. Entries are tied to the modification times of the folder and the
+    folders the candidates are looked for in, so they become invalid as soon
+    as a file is added to one of them. A lookup only counts as a hit when the
+    search is known to fail.
+    """
+
+    def __init__(self, limit=NEGATIVE_LIMIT):
+        super(NegativeCache, self).__init__(limit)
+        self.probes_avoided = 0
+
+    @staticmethod
+    def signature(folder_path, candidates=()):
+        """
+        Get the modification times of a folder and the candidates' folders.
+
+        :param folder_path: the folder to check
+        :param candidates: list of (pattern, path) tuples, callable paths are
+            expected to look in folder_path
+        :return: tuple of modification times, None for missing folders
+        """
+        folders = [os.path.normpath(folder_path)]
+        for _, path in candidates:
+            if not callable(path):
+                folder = os.path.dirname(path)
+                if folder not in folders:
+                    folders.append(folder)
+        signature = []
+        for folder in folders:
+            try:
+                signature.append(os.stat(folder).st_mtime)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    @staticmethod
+    def search_key(kind, candidates):
+        """
+        Identify a search by the kind of file and its candidates.
+
+        :param kind: the kind of file (nfo, poster, fanart)
+        :param candidates: list of (pattern, path) tuples, callable paths are
+            identified by their pattern
+        :return: a hashable key
+        """
+        return (kind,) + tuple(
+            pattern if callable(path) else path for pattern, path in candidates
+        )
+
+    def is_missing(self, folder_path, search, signature, probes):
+        """
+        Check if a search is known to fail in a folder.
+
+        :param folder_path: the folder to check
+        :param search: the key of the search, see search_key
+        :param signature: the current signature of the folder
+        :param probes: number of probes a lookup would cost
+        :return: True if the file is known to be missing
+        """
+        entry = self.lookup(
+            folder_path, lambda entry: entry[0] == signature and search in entry[1]
+        )
+        if entry is None:
+            return False
+        with self._lock:
+            self.probes_avoided += probes
+        return True
+
+    def add(self, folder_path, search, signature):
+        """
+        Remember that a search failed in a folder.
+
+        :param folder_path: the folder that was searched
+        :param search: the key of the search, see search_key
+        :param signature: the signature of the folder at the time of the search
+        """
+        with self._lock:
+            entry = self._find(folder_path, lambda entry: entry[0] == signature)
+            if entry is None:
+                entry = (signature, set())
+                self._store(folder_path, entry)
+            entry[1].add(search)
+
+    def stats(self):
+        """
+        :return: dict with the number of entries, hits, misses, evictions and
+            avoided probes
+        """
+        stats = super(NegativeCache, self).stats()
+        stats["probes_avoided"] = self.probes_avoided
+        return stats
+
+
+negative_cache = NegativeCache()
+
+
+def get_library_root(title_root):
+    """
+    Get the library root a movie folder belongs to.
+
+    :param title_root: the title folder of the movie
+    :return: the parent folder of the title folder
+    """
+    return os.path.dirname(title_root)
+
+
+def find_first_nfo(folder_path):
+    """
+    Find the first .nfo file in a folder.
+
+    :param folder_path: the folder to search in
+    :return: the path of the .nfo file or None
+    """
+    listing = get_folder_listing(folder_path)
+    for name in listing.names if listing else ():
+        if name.endswith(".nfo") and listing.is_file(name):
+            return os.path.join(folder_path, name)
+    log.debug("No NFO file found in {path!r}".format(path=folder_path))
+    return None
+
+
+def get_nfo_candidates(
+    related_bases, folder_path, movie_name_with_year, movie_name, movie_nfo=False
+):
+    """
+    Get the candidates for a movie's .nfo file.
+
+    :param related_bases: the movie's base file in each of the RELATED_DIRS
+    :param folder_path: the folder of the movie
+    :param movie_name_with_year: movie name from folder (with year)
+    :param movie_name: movie name from folder
+    :param movie_nfo: also try movie.nfo in the movie folder
+    :return: tuple of (pattern, path) tuples
+    """
+    candidates = list(
+        zip(
+            ["related:" + i for i in RELATED_DIRS],
+            [base + ".nfo" for base in related_bases],
+        )
+    )
+    candidates.extend(
+        [
+            # moviename.nfo
+            ("folder_with_year", "{movie}.nfo".format(movie=movie_name_with_year)),
+            ("folder", "{movie}.nfo".format(movie=movie_name)),
+        ]
+    )
+    if movie_nfo:
+        candidates.append(("movie", os.path.join(folder_path, "movie.nfo")))
+    # last resort - use first found .nfo
+    candidates.append(("first_nfo", lambda: find_first_nfo(folder_path)))
+    return tuple(candidates)
+
+
+def get_artwork_candidates(
+    related_bases, folder_path, movie_name_with_year, movie_name, kind
+):
+    """
+    Get the candidates for a movie's artwork.
+
+    :param related_bases: the movie's base file in each of the RELATED_DIRS
+    :param folder_path: the folder of the movie
+    :param movie_name_with_year: movie name from folder (with year)
+    :param movie_name: movie name from folder
+    :param kind: the kind of artwork (poster, fanart)
+    :return: tuple of (pattern, path) tuples
+    """
+    suffix = "-{kind}.jpg".format(kind=kind)
+    candidates = list(
+        zip(
+            ["related:" + i for i in RELATED_DIRS],
+            [base + suffix for base in related_bases],
+        )
+    )
+    candidates.extend(
+        [
+            # Eden / Frodo
+            ("folder_with_year", movie_name_with_year + suffix),
+            ("folder", movie_name + suffix),
+            ("plain", os.path.join(folder_path, kind + ".jpg")),
+        ]
+    )
+    candidates.extend(
+        [(pattern + ":png", replace_jpg_png(path)) for pattern, path in candidates]
+    )
+    return tuple(candidates)
+
+
+def unique_candidates(candidates):
+    """
+    Drop candidates whose path is already probed by an earlier one.
+
+    :param candidates: tuple of (pattern, path) tuples
+    :return: tuple of (pattern, path) tuples
+    """
+    seen = set()
+    unique = []
+    for pattern, path in candidates:
+        if path not in seen:
+            seen.add(path)
+            unique.append((pattern, path))
+    return tuple(unique)
+
+
+class PathPlan(
+    namedtuple(
+        "PathPlan",
+        (
+            "video_file",
+            "folder_path",
+            "file_stem",
+            "base_stem",
+            "layout",
+            "title_root",
+            "library_root",
+            "movie_name_with_year",
+            "movie_name",
+            "nfo",
+            "search_nfo",
+            "poster",
+            "fanart",
+        ),
+    )
+):
+    """
+    Paths derived from a media file.
+
+    video_file, folder_path: the media file and its folder
+    file_stem: the media file's name without extension
+    base_stem: the file stem without CD / DVD or part information
+    layout: the disc layout ("video_ts", "bdmv", "iso") or None
+    title_root: the folder holding the nfo and artwork, the folder of the disc
+        structure for discs and folder_path otherwise
+    library_root: the library root the hit rates are kept for
+    movie_name_with_year, movie_name: movie names from the title folder
+    nfo, search_nfo, poster, fanart: tuples of (pattern, path) candidates
+    """
+
+    __slots__ = ()
+
+
+def build_path_plan(video_file):
+    """
+    Compute the path plan of a media file.
+
+    :param video_file: the media file
+    :return: a PathPlan
+    """
+    folder_path, file_name = os.path.split(video_file)
+    disc = get_disc_layout(video_file)
+    title_root = disc.title_root
+    # Movie name with year from folder
+    movie_name_with_year = get_movie_name_from_folder(title_root, True)
+    # Movie name from folder
+    movie_name = get_movie_name_from_folder(title_root, False)
+    if disc.disc_nfo:
+        # files named after the disc's own files are not looked for, Kodi
+        # keeps the nfo inside the structure or as movie.nfo next to it
+        related_bases = ()
+        disc_nfo = (("disc", disc.disc_nfo),)
+    else:
+        related_bases = get_related_files(video_file, "")
+        disc_nfo = ()
+    names = (related_bases, title_root, movie_name_with_year, movie_name)
+    nfo = get_nfo_candidates(*names, movie_nfo=bool(disc_nfo))
+    return PathPlan(
+        video_file=video_file,
+        folder_path=folder_path,
+        file_stem=os.path.splitext(file_name)[0],
+        base_stem=get_base_file(file_name),
+        layout=disc.layout,
+        title_root=title_root,
+        library_root=get_library_root(title_root),
+        movie_name_with_year=movie_name_with_year,
+        movie_name=movie_name,
+        nfo=unique_candidates(disc_nfo + nfo),
+        search_nfo=unique_candidates(
+            disc_nfo + get_nfo_candidates(*names, movie_nfo=True)
+        ),
+        poster=unique_candidates(get_artwork_candidates(*names, kind="poster")),
+        fanart=unique_candidates(get_artwork_candidates(*names, kind="fanart")),
+    )
+
+
+class PathPlanCache(LRUCache):
+    """
+    Memoizes the path plans of the most recently used media files.
+    """
+
+    def __init__(self, limit=PATH_PLAN_LIMIT):
+        super(PathPlanCache, self).__init__(limit)
+
+    def get(self, video_file):
+        """
+        Get the path plan of a media file.
+
+        :param video_file: the media file
+        :return: a PathPlan
+        """
+        plan = self.lookup(video_file)
+        if plan is None:
+            plan = build_path_plan(video_file)
+            self.put(video_file, plan)
+        return plan
+
+
+path_plans = PathPlanCache()
+get_path_plan = path_plans.get
+
+
+def resolve_file(root, kind, candidates, file_type=None, folder_path=None):
+    """
+    Check candidates in order of their hit rate and return the first one found.
+
+    :param root: library root the hit rates are kept for
+    :param kind: the kind of file (nfo, poster, fanart)
+    :param candidates: list of (pattern, path) tuples. The path may be a
+        callable returning a path or None for expensive candidates.
+    :param file_type: (Optional) Type of file searched for. Used for logging.
+    :param folder_path: (Optional) Folder of the movie. Enables the negative
+        cache for folders where the same candidates were not found.
+    :return: a valid filename or None
+    """
+    if folder_path:
+        signature = negative_cache.signature(folder_path, candidates)
+        search = negative_cache.search_key(kind, candidates)
+        if negative_cache.is_missing(folder_path, search, signature, len(candidates)):
+            log.debug(
+                "No {type} file in {path!r} since last change, skipped {number}"
+                " probes ({total} in total)".format(
+                    type=file_type if file_type else "valid",
+                    path=folder_path,
+                    number=len(candidates),
+                    total=negative_cache.probes_avoided,
+                )
+            )
+            return None
+    for pattern, filename in candidate_stats.order(root, kind, candidates):
+        if callable(filename):
+            filename = filename()
+            if not filename:
+                continue
+        log.debug("Trying {name}".format(name=filename))
+        if os.path.exists(filename):
+            log.info(
+                "Found {type} file {name}".format(
+                    type=file_type if file_type else "a",
+                    name=filename,
+                )
+            )
+            candidate_stats.record(root, kind, pattern)
+            return filename
+    log.info(
+        "No {type} file found! Aborting!".format(
+            type=file_type if file_type else "valid"
+        )
+    )
+    if folder_path:
+        negative_cache.add(folder_path, search, signature)
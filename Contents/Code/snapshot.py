@@ -0,0 +1,559 @@
+# coding=utf-8
+
+"""
+Memory-mapped, read-only snapshot of extracted nfo records.
+
+The snapshot is shared by all agent processes. Records are looked up in place
+through the mapping and fields are only decoded when they are accessed.
+
+File layout (little endian)::
+
+    header   magic, version, field count, record count, pool offset
+    entries  one fixed size entry per record, sorted by key:
+             key offset, key length, nfo mtime, nfo size and an
+             (offset, length) pair into the string pool for every field
+    pool     utf-8 encoded keys and field values
+
+New records are collected in memory and merged with the current snapshot into
+a new file, which is then renamed over the old one. Records of the current
+snapshot are copied as they are, without decoding them. Readers notice the
+replaced file and map it again, so they never see a partially written
+snapshot. Records of nfo files that no longer exist are dropped once a day.
+
+Windows does not allow replacing a file that is mapped, so the snapshot is
+disabled there.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from __init__ import create_thread
+from __init__ import data_path
+from __init__ import is_below
+from __init__ import log
+
+SNAPSHOT_NAME = "records.snapshot"
+SNAPSHOT_MAGIC = b"XNFS"
+# 2: records hold all roles instead of the first maxactors
+SNAPSHOT_VERSION = 2
+
+# (field, type) of the record fields stored in the snapshot. Changing this
+# list requires a new SNAPSHOT_VERSION.
+SNAPSHOT_FIELDS = (
+    ("title", "text"),
+    ("title_sort", "text"),
+    ("year", "int"),
+    ("rating", "float"),
+    ("tagline", "text"),
+    ("summary", "text"),
+    ("original_title", "text"),
+    ("content_rating", "text"),
+    ("studio", "text"),
+    ("release_date", "text"),
+    ("writers", "list"),
+    ("directors", "list"),
+    ("genres", "list"),
+    ("countries", "list"),
+    ("collections", "list"),
+    ("duration", "int"),
+    ("roles", "roles"),
+)
+FIELD_INDEX = dict((name, i) for i, (name, _) in enumerate(SNAPSHOT_FIELDS))
+
+HEADER = struct.Struct("<4sHHII")
+ENTRY = struct.Struct("<IIdQ" + "II" * len(SNAPSHOT_FIELDS))
+MISSING = 0xFFFFFFFF
+LIST_SEPARATOR = "\x1f"
+ROLE_SEPARATOR = "\x1e"
+
+# The snapshot is rebuilt once REBUILD_INTERVAL new records, and at least
+# REBUILD_GROWTH times the snapshot's records, were collected, or when the
+# oldest of them has been waiting for REBUILD_AGE seconds. Growing the
+# snapshot by a fraction of its size keeps the cost of an import linear.
+REBUILD_INTERVAL = 50
+REBUILD_GROWTH = 0.1
+REBUILD_AGE = 300
+# Maximum number of records waiting for a rebuild. A rebuild starts at the
+# latest once it is reached; beyond it, the oldest records are only dropped
+# while a rebuild is already running.
+PENDING_LIMIT = 2000
+# Seconds between two checks for records of deleted nfo files.
+PRUNE_INTERVAL = 24 * 60 * 60
+# Seconds between two checks for a snapshot replaced by another process.
+RELOAD_INTERVAL = 30
+
+
+def to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+
+def to_text(data):
+    return data.decode("utf-8")
+
+
+def encode_field(kind, value):
+    if kind == "text":
+        return to_bytes(value)
+    if kind in ("int", "float"):
+        return to_bytes(repr(value))
+    if kind == "list":
+        return to_bytes(
+            LIST_SEPARATOR.join(
+                i.decode("utf-8") if isinstance(i, bytes) else i for i in value
+            )
+        )
+    return to_bytes(
+        LIST_SEPARATOR.join(
+            ROLE_SEPARATOR.join(
+                i.decode("utf-8") if isinstance(i, bytes) else i or "" for i in role
+            )
+            for role in value
+        )
+    )
+
+
+def decode_field(kind, data):
+    if kind == "text":
+        return to_text(data)
+    if kind == "int":
+        return int(data)
+    if kind == "float":
+        return float(data)
+    if not data:
+        return []
+    if kind == "list":
+        return to_text(data).split(LIST_SEPARATOR)
+    return [
+        tuple(role.split(ROLE_SEPARATOR))
+        for role in to_text(data).split(LIST_SEPARATOR)
+    ]
+
+
+class SnapshotRecord(object):
+    """
+    Read-only view of a record inside the snapshot.
+
+    Supports the parts of the dict interface apply_record needs. Fields are
+    decoded from the mapping on every access.
+    """
+
+    def __init__(self, buf, fields):
+        self._buf = buf
+        self._fields = fields
+
+    def _slice(self, key):
+        i = FIELD_INDEX[key] * 2
+        offset, length = self._fields[i], self._fields[i + 1]
+        if length == MISSING:
+            raise KeyError(key)
+        return self._buf[offset : offset + length]
+
+    def __getitem__(self, key):
+        return decode_field(SNAPSHOT_FIELDS[FIELD_INDEX[key]][1], self._slice(key))
+
+    def __contains__(self, key):
+        return key in FIELD_INDEX and self._fields[FIELD_INDEX[key] * 2 + 1] != MISSING
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [name for name, _ in SNAPSHOT_FIELDS if name in self]
+
+    def to_dict(self):
+        return dict((key, self[key]) for key in self.keys())
+
+
+class SnapshotReader(object):
+    """
+    Memory-mapped snapshot file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as snapshot_file:
+            self.identity = os.fstat(snapshot_file.fileno())
+            self._buf = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, fields, self.count, self._pool = HEADER.unpack_from(
+            self._buf, 0
+        )
+        if (
+            magic != SNAPSHOT_MAGIC
+            or version != SNAPSHOT_VERSION
+            or fields != len(SNAPSHOT_FIELDS)
+        ):
+            self.close()
+            raise ValueError("Incompatible snapshot {path}".format(path=path))
+
+    def close(self):
+        self._buf.close()
+
+    def _entry(self, i):
+        return ENTRY.unpack_from(self._buf, HEADER.size + i * ENTRY.size)
+
+    def entries(self):
+        """
+        Iterate over the raw entries, in key order.
+
+        :return: iterator of (key, entry) tuples, the key as bytes
+        """
+        for i in range(self.count):
+            entry = self._entry(i)
+            yield self._key(entry), entry
+
+    def slice(self, offset, length):
+        return self._buf[offset : offset + length]
+
+    def _key(self, entry):
+        return self._buf[entry[0] : entry[0] + entry[1]]
+
+    def find(self, key):
+        """
+        Binary search for a record.
+
+        :param key: the key of the record
+        :return: tuple (mtime, size, SnapshotRecord) or None
+        """
+        key = to_bytes(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            entry_key = self._key(entry)
+            if entry_key < key:
+                low = middle + 1
+            elif entry_key > key:
+                high = middle
+            else:
+                return entry[2], entry[3], SnapshotRecord(self._buf, entry[4:])
+        return None
+
+    def items(self):
+        """
+        Iterate over all records.
+
+        :return: iterator of (key, mtime, size, SnapshotRecord) tuples
+        """
+        for i in range(self.count):
+            entry = self._entry(i)
+            yield (
+                to_text(self._key(entry)),
+                entry[2],
+                entry[3],
+                SnapshotRecord(self._buf, entry[4:]),
+            )
+
+
+def merge_entries(records, reader, drop):
+    """
+    Merge new records into the entries of a snapshot, in key order.
+
+    :param records: dict mapping keys to (mtime, size, record) tuples
+    :param reader: the SnapshotReader of the current snapshot or None
+    :param drop: set of keys (bytes) of the snapshot to leave out
+    :return: iterator of (key, record tuple or None, raw entry or None)
+    """
+    new = sorted((to_bytes(key), key) for key in records)
+    old = reader.entries() if reader else iter(())
+    old_entry = next(old, None)
+    for key, text_key in new:
+        while old_entry is not None and old_entry[0] <= key:
+            if old_entry[0] < key and old_entry[0] not in drop:
+                yield old_entry[0], None, old_entry[1]
+            old_entry = next(old, None)
+        yield key, records[text_key], None
+    while old_entry is not None:
+        if old_entry[0] not in drop:
+            yield old_entry[0], None, old_entry[1]
+        old_entry = next(old, None)
+
+
+def write_snapshot(path, records, reader=None, drop=frozenset()):
+    """
+    Write a snapshot atomically.
+
+    Records of the current snapshot are copied without decoding them.
+
+    :param path: the path of the snapshot
+    :param records: dict mapping keys to new (mtime, size, record) tuples
+    :param reader: (Optional) the SnapshotReader of the current snapshot
+    :param drop: (Optional) set of keys (bytes) of the snapshot to leave out
+    :return: the number of records written
+    """
+    pool = []
+    pool_size = [0]
+
+    def add(data):
+        offset = pool_size[0]
+        pool.append(data)
+        pool_size[0] += len(data)
+        return offset, len(data)
+
+    # offsets are relative to the pool until the number of entries is known
+    entries = []
+    for key, new, entry in merge_entries(records, reader, drop):
+        values = []
+        if new is not None:
+            mtime, size, record = new
+            for name, kind in SNAPSHOT_FIELDS:
+                value = record.get(name)
+                if value is None:
+                    values.extend((0, MISSING))
+                else:
+                    values.extend(add(encode_field(kind, value)))
+        else:
+            mtime, size = entry[2], entry[3]
+            fields = entry[4:]
+            for i in range(0, len(fields), 2):
+                if fields[i + 1] == MISSING:
+                    values.extend((0, MISSING))
+                else:
+                    values.extend(add(reader.slice(fields[i], fields[i + 1])))
+        values[:0] = add(key)
+        entries.append((mtime or 0.0, size or 0, values))
+
+    pool_offset = HEADER.size + ENTRY.size * len(entries)
+    packed = []
+    for mtime, size, values in entries:
+        values = [
+            value + pool_offset if i % 2 == 0 else value
+            for i, value in enumerate(values)
+        ]
+        packed.append(ENTRY.pack(values[0], values[1], mtime, size, *values[2:]))
+
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    temp_path = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+    with open(temp_path, "wb") as snapshot_file:
+        snapshot_file.write(
+            HEADER.pack(
+                SNAPSHOT_MAGIC,
+                SNAPSHOT_VERSION,
+                len(SNAPSHOT_FIELDS),
+                len(packed),
+                pool_offset,
+            )
+        )
+        snapshot_file.write(b"".join(packed))
+        snapshot_file.write(b"".join(pool))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    # atomic on POSIX, the snapshot is not used on Windows
+    os.rename(temp_path, path)
+    return len(packed)
+
+
+class RecordSnapshot(object):
+    """
+    Shared snapshot of nfo records, validated against the nfo's mtime and size.
+    """
+
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._reader = None
+        self._checked = 0
+        self._pending = OrderedDict()
+        self._writing = {}
+        self._pending_since = None
+        self._rebuilding = False
+        self._pruned = 0
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.dropped = 0
+        self.pruned = 0
+
+    def _current(self):
+        """
+        Get the reader, mapping the snapshot again if it was replaced.
+        """
+        now = time.time()
+        with self._lock:
+            if self._reader is not None and now - self._checked < RELOAD_INTERVAL:
+                return self._reader
+            self._checked = now
+            try:
+                identity = os.stat(self.path)
+            except OSError:
+                return self._reader
+            if self._reader is not None and (
+                (identity.st_ino, identity.st_mtime)
+                == (self._reader.identity.st_ino, self._reader.identity.st_mtime)
+            ):
+                return self._reader
+            try:
+                reader = SnapshotReader(self.path)
+            except (EnvironmentError, ValueError, struct.error) as e:
+                log.debug("Unable to map snapshot: {error}".format(error=e))
+                return self._reader
+            # old mappings stay valid for records still in use elsewhere
+            self._reader = reader
+            return reader
+
+    def lookup(self, nfo_file):
+        """
+        Get the record of an nfo file, if it has not changed since.
+
+        :param nfo_file: the nfo file
+        :return: a record or None
+        """
+        if not self.enabled:
+            return None
+        try:
+            stat = os.stat(nfo_file)
+        except OSError:
+            return None
+        with self._lock:
+            pending = self._pending.get(nfo_file) or self._writing.get(nfo_file)
+        if pending and pending[:2] == (stat.st_mtime, stat.st_size):
+            self.hits += 1
+            return pending[2]
+        reader = self._current()
+        found = reader.find(nfo_file) if reader else None
+        if found and found[:2] == (stat.st_mtime, stat.st_size):
+            self.hits += 1
+            log.debug("Using snapshot record of {nfo}".format(nfo=nfo_file))
+            return found[2]
+        self.misses += 1
+        return None
+
+    def add(self, nfo_file, record):
+        """
+        Add a complete record; the snapshot is rebuilt in the background.
+
+        :param nfo_file: the nfo file the record was extracted from
+        :param record: the record
+        """
+        if not self.enabled:
+            return
+        try:
+            stat = os.stat(nfo_file)
+        except OSError:
+            return
+        reader = self._current()
+        threshold = min(
+            max(REBUILD_INTERVAL, int(REBUILD_GROWTH * reader.count) if reader else 0),
+            PENDING_LIMIT,
+        )
+        with self._lock:
+            self._pending.pop(nfo_file, None)
+            self._pending[nfo_file] = (stat.st_mtime, stat.st_size, record)
+            if self._pending_since is None:
+                self._pending_since = time.time()
+            rebuild = not self._rebuilding and (
+                len(self._pending) >= threshold
+                or time.time() - self._pending_since >= REBUILD_AGE
+            )
+            if rebuild:
+                self._rebuilding = True
+            else:
+                # the oldest records are usually the ones being written
+                while len(self._pending) > PENDING_LIMIT:
+                    key, value = self._pending.popitem(last=False)
+                    if self._writing.get(key) is not value:
+                        self.dropped += 1
+        if rebuild:
+            create_thread(self.rebuild)
+
+    def rebuild(self):
+        """
+        Merge the pending records into a new snapshot.
+        """
+        with self._lock:
+            self._rebuilding = True
+            pending = self._writing = dict(self._pending)
+        try:
+            reader = self._current()
+            drop = set()
+            if reader and time.time() - self._pruned >= PRUNE_INTERVAL:
+                drop = self.find_deleted(reader)
+                self._pruned = time.time()
+            number = write_snapshot(self.path, pending, reader, drop)
+            log.debug(
+                "Snapshot rebuilt with {number} records, {new} new, {deleted}"
+                " deleted".format(number=number, new=len(pending), deleted=len(drop))
+            )
+            with self._lock:
+                self._checked = 0
+                self.rebuilds += 1
+                self.pruned += len(drop)
+        except Exception as e:
+            # the records stay in the record cache, they are not kept for
+            # another attempt
+            log.error("Unable to rebuild snapshot: {error}".format(error=e))
+            with self._lock:
+                self.dropped += len(pending)
+        finally:
+            with self._lock:
+                for key, value in pending.items():
+                    if self._pending.get(key) is value:
+                        del self._pending[key]
+                self._pending_since = time.time() if self._pending else None
+            with self._lock:
+                self._writing = {}
+                self._rebuilding = False
+
+    @staticmethod
+    def find_deleted(reader):
+        """
+        Find the records of nfo files that no longer exist.
+
+        :param reader: the SnapshotReader
+        :return: set of keys (bytes)
+        """
+        return set(
+            key for key, _ in reader.entries() if not os.path.exists(to_text(key))
+        )
+
+    def discard(self, root=None):
+        """
+        Drop the pending records of the nfo files inside a folder.
+
+        Records already in the snapshot stay, they are validated against the
+        nfo's mtime and size on every lookup.
+
+        :param root: (Optional) the folder, all pending records if None
+        :return: number of dropped records
+        """
+        with self._lock:
+            keys = [key for key in self._pending if is_below(key, root)]
+            for key in keys:
+                del self._pending[key]
+            if not self._pending:
+                self._pending_since = None
+        return len(keys)
+
+    def stats(self):
+        """
+        :return: dict with record counts, mapped bytes, hits and misses
+        """
+        reader = self._current()
+        with self._lock:
+            return {
+                "entries": reader.count if reader else 0,
+                "bytes": reader.identity.st_size if reader else 0,
+                "enabled": self.enabled,
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+                "rebuilds": self.rebuilds,
+                "dropped": self.dropped,
+                "pruned": self.pruned,
+            }
+
+
+record_snapshot = RecordSnapshot(
+    os.path.join(data_path, SNAPSHOT_NAME), enabled=os.name != "nt"
+)
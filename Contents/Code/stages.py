@@ -0,0 +1,205 @@
+# coding=utf-8
+
+"""
+Deadline aware execution of the heavy update stages.
+
+Core fields of a title are always applied inline. Heavy stages (artwork,
+actors, durations, subtitles) run inline as long as the title's time budget
+lasts and are handed to a background completion queue afterwards. Plex saves
+the metadata when ``update`` returns, so the payloads prepared in the
+background are applied by the next update of the same title. Nothing triggers
+that update: deferred stages stay pending until the title is refreshed again,
+as the updatebudget preference's label says.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from __init__ import create_thread
+from __init__ import is_below
+from __init__ import log
+from __init__ import preferences
+
+# Maximum number of prepared payloads waiting to be applied. Artwork payloads
+# hold the image data, so the oldest ones are dropped beyond this limit.
+COMPLETED_LIMIT = 200
+
+
+def get_update_budget():
+    """
+    Get the time budget per title from the preferences.
+
+    :return: budget in seconds, 0 if disabled
+    """
+    try:
+        return max(float(preferences["updatebudget"] or 0), 0)
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+class Deadline(object):
+    """
+    Time budget of a single update.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.start = time.time()
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def expired(self):
+        return bool(self.budget) and self.elapsed() > self.budget
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, TypeError):
+        return None
+
+
+class CompletionQueue(object):
+    """
+    Prepares deferred stages in a background thread.
+
+    Payloads are stored per stage and source file together with the source's
+    modification time, so a payload is only used while its source is
+    unchanged.
+    """
+
+    def __init__(self, limit=COMPLETED_LIMIT):
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._pending = set()
+        self._completed = OrderedDict()
+        self._worker = None
+        self.deferred = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, stage, source, prepare, *args):
+        """
+        Queue the preparation of a stage.
+
+        :param stage: name of the stage
+        :param source: file the stage's payload is read from
+        :param prepare: callable returning the payload
+        :param args: arguments for prepare
+        """
+        key = (stage, source)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            self.deferred += 1
+            if self._worker is None:
+                self._worker = create_thread(self._work)
+        self._queue.put((key, prepare, args))
+
+    def pop(self, stage, source):
+        """
+        Take the prepared payload of a stage.
+
+        :param stage: name of the stage
+        :param source: file the stage's payload is read from
+        :return: tuple (found, payload)
+        """
+        with self._lock:
+            entry = self._completed.pop((stage, source), None)
+        if entry is None or entry[0] != get_mtime(source):
+            return False, None
+        return True, entry[1]
+
+    def _work(self):
+        while True:
+            key, prepare, args = self._queue.get()
+            mtime = get_mtime(key[1])
+            try:
+                payload = prepare(*args)
+            except Exception as e:
+                log.error(
+                    "Deferred {stage} stage for {source} failed: {error}".format(
+                        stage=key[0], source=key[1], error=e
+                    )
+                )
+                with self._lock:
+                    self._pending.discard(key)
+                    self.failed += 1
+                continue
+            with self._lock:
+                self._pending.discard(key)
+                self._completed[key] = (mtime, payload)
+                while len(self._completed) > self._limit:
+                    self._completed.popitem(last=False)
+                self.completed += 1
+
+    def discard(self, root=None):
+        """
+        Drop the prepared payloads of the files inside a folder.
+
+        :param root: (Optional) the folder, all payloads if None
+        :return: number of dropped payloads
+        """
+        with self._lock:
+            keys = [key for key in self._completed if is_below(key[1], root)]
+            for key in keys:
+                del self._completed[key]
+        return len(keys)
+
+    def stats(self):
+        """
+        :return: dict with queue and payload counters
+        """
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "prepared": len(self._completed),
+                "deferred": self.deferred,
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+
+completion_queue = CompletionQueue()
+
+
+def run_stage(deadline, stage, source, prepare, apply, *args):
+    """
+    Run a heavy update stage within the title's time budget.
+
+    A payload prepared in the background is applied right away. Otherwise the
+    stage is prepared inline, unless the deadline has passed, in which case it
+    is queued for the next update of the title.
+
+    :param deadline: the Deadline of the update
+    :param stage: name of the stage
+    :param source: file the stage's payload is read from
+    :param prepare: callable returning the payload
+    :param apply: callable applying the payload to the metadata
+    :param args: arguments for prepare
+    :return: True if the stage was applied
+    """
+    found, payload = completion_queue.pop(stage, source)
+    if not found:
+        if deadline.expired():
+            log.info(
+                "Time budget of {budget}s exceeded after {elapsed:.2f}s,"
+                " deferring {stage} stage".format(
+                    budget=deadline.budget, elapsed=deadline.elapsed(), stage=stage
+                )
+            )
+            completion_queue.submit(stage, source, prepare, *args)
+            return False
+        payload = prepare(*args)
+    apply(payload)
+    return True
@@ -4,6 +4,70 @@ from __init__ import PlexLogAdapter
 from __init__ import XBMCLogAdapter
 from __init__ import preferences
 from __init__ import log
+from __init__ import instrumented
+from __init__ import LazyRegex
+from listing import get_folder_listing
+from lru import LRUCache
+from resolver import get_path_plan
+
+IDX_CHUNK_SIZE = 64 * 1024
+IDX_ID_REGEX = LazyRegex(br'^id: ([A-Za-z]{2})(?:, index: ([0-9]+))?', re.MULTILINE)
+# Number of .idx files whose languages are kept in memory
+IDX_CACHE_LIMIT = 2000
+
+def read_idx_languages(idx_file):
+    """
+    Read the languages of a VobSub .idx file.
+
+    Every language's 'id:' line is followed by its timestamp lines, so the whole
+    file is scanned, but in chunks and without splitting it into lines. Only the
+    header line and the 'id:' lines are parsed.
+
+    :param idx_file: The .idx file
+    :return: list of (language code, index) tuples or None if the file is not a VobSub index file
+    """
+    languages = []
+    with open(idx_file, 'rb') as idx:
+        if b'VobSub index file' not in idx.readline():
+            return None
+        rest = b''
+        while True:
+            chunk = idx.read(IDX_CHUNK_SIZE)
+            data = rest + chunk
+            # Keep the last, possibly incomplete line for the next chunk
+            end = data.rfind(b'\n') + 1 if chunk else len(data)
+            for match in IDX_ID_REGEX.finditer(data, 0, end):
+                index = match.group(2)
+                languages.append((match.group(1).decode('ascii').lower(), int(index) if index else len(languages)))
+            rest = data[end:]
+            if not chunk:
+                return languages
+
+class IdxCache(LRUCache):
+    """
+    Languages of VobSub .idx files, validated by the file's mtime and size.
+    """
+
+    def __init__(self, limit=IDX_CACHE_LIMIT):
+        super(IdxCache, self).__init__(limit)
+
+    def get(self, idx_file):
+        """
+        Get the languages of a VobSub .idx file, reading the file only if it changed.
+
+        :param idx_file: The .idx file
+        :return: see read_idx_languages
+        """
+        stat = os.stat(idx_file)
+        key = (stat.st_mtime, stat.st_size)
+        entry = self.lookup(idx_file, lambda entry: entry[0] == key)
+        if entry is not None:
+            return entry[1]
+        languages = read_idx_languages(idx_file)
+        self.put(idx_file, (key, languages))
+        return languages
+
+idx_cache = IdxCache()
 
 def process_subtitle_files(part):
     """
@@ -16,10 +80,26 @@ def process_subtitle_files(part):
     :param part: The part of the movie to use for searching
     :return: list containing related subtitle files
     """
+    subtitle_files = find_subtitle_files(part.file)
+    add_subtitle_files(part, subtitle_files)
+    return subtitle_files
+
+@instrumented("subtitles", lambda args: args[0])
+def find_subtitle_files(part_file):
+    """
+    Search for related subtitle files without touching the media item.
+
+    This does all the file system work of process_subtitle_files, so it can
+    run in the background. Use add_subtitle_files to add the results.
+
+    :param part_file: The file of the part to use for searching
+    :return: list containing related subtitle files
+    """
     subtitle_files = []
     SUB_EXT = [ '.idx', '.sub', '.srt', '.smi', '.utf', '.utf8', '.utf-8', '.rt', '.ssa', '.ass', '.aqt', '.jss', '.txt', '.psb' ]
-    (part_file_path, part_file_name) = os.path.split(part.file)
-    (part_file_base_name, part_file_ext) = os.path.splitext(part_file_name)
+    plan = get_path_plan(part_file)
+    part_file_path = plan.folder_path
+    part_file_base_name = plan.file_stem
     search_paths = [ part_file_path ]
     
     try:
@@ -36,11 +116,9 @@ def process_subtitle_files(part):
     for search_path in search_paths:
         log.debug("Searching for subtitles in: {}".format(search_path))
         sub_files_in_path = 0
-        for file in os.listdir(search_path):
-            # If we are dealing with a folder, skip
-            if not os.path.isfile(os.path.join(search_path, file)):
-                continue
-            
+        listing = get_folder_listing(search_path)
+        # Folders are not part of the listing's files
+        for file in listing.files if listing else []:
             # Extract the basename and file extension from the file
             (file_base_name, file_ext) = os.path.splitext(file)
             file_ext = file_ext.lower()
@@ -94,41 +172,45 @@ def process_subtitle_files(part):
                 "full_name_no_ext": full_name_no_ext,
                 "format": "",
                 "codec": "",
+                "index": None,
                 "status": ""
             }
             
-            idx_full_name = full_name_no_ext + '.idx'
-            if file_ext == '.sub' and os.path.exists(idx_full_name):
+            idx_name = file_base_name + '.idx'
+            idx_full_name = os.path.join(search_path, idx_name)
+            if file_ext == '.sub' and idx_name in listing.files:
                 
                 # Process vobsub formatted files
-                log.debug("Attempting to process subtitle file: {} for found .sub file: []}".format(idx_full_name, full_name))
-                idx_content = Core.storage.load(idx_full_name)
+                log.debug("Attempting to process subtitle file: {} for found .sub file: {}".format(idx_full_name, full_name))
+                try:
+                    idx_languages = idx_cache.get(idx_full_name)
+                except (IOError, OSError) as err:
+                    log.debug("Unable to read idx subtitle file: {}".format(idx_full_name))
+                    log.debug("Details: {}".format(err))
+                    idx_languages = None
                 
-                if idx_content.count('VobSub index file') == 0:
+                if idx_languages is None:
                     log.debug("Unknown format, ignoring idx subtitle file: {}".format(idx_full_name))
                     file_vars["status"] = "error"
                     subtitle_files.append(file_vars)
                     continue
                 
-                idx_language_index = 0
-                idx_languages = re.findall('\nid: ([A-Za-z]{2})', idx_content)
-                
                 # If no languages are found, move on to the next file
-                if idx_language_index < 1:
+                if not idx_languages:
                     log.debug("Unable to find languages in file: {}".format(idx_full_name))
                     file_vars["status"] = "error"
                     subtitle_files.append(file_vars)
                     continue
                     
-                for idx_lang_code in idx_languages:
-                    log.debug("Found landuage '{}' in file: {}".format(idx_lang_code, idx_full_name))
-                    part.subtitles[idx_lang_code][file_base_name] = Proxy.LocalFile(idx_full_name, index = str(idx_language_index), format = "vobsub")
-                    idx_language_index += 1
-                    
-                    file_vars["lang_code"] = idx_lang_code
-                    file_vars["format"] = "vobsub"
-                    file_vars["status"] = "success"
-                    subtitle_files.append(file_vars)
+                for idx_lang_code, idx_language_index in idx_languages:
+                    log.debug("Found language '{}' in file: {}".format(idx_lang_code, idx_full_name))
+                    idx_vars = dict(file_vars)
+                    idx_vars["full_name"] = idx_full_name
+                    idx_vars["lang_code"] = idx_lang_code
+                    idx_vars["format"] = "vobsub"
+                    idx_vars["index"] = str(idx_language_index)
+                    idx_vars["status"] = "success"
+                    subtitle_files.append(idx_vars)
                 
                 # When finished processing all the languages in the idx file, move on to the next file  
                 continue
@@ -137,11 +219,15 @@ def process_subtitle_files(part):
                 try:
                     #sub_file_contents = Core.storage.load(full_name)
                     sub_file_lines = [ line.strip() for line in Core.storage.load(full_name).splitlines(True) ]
-                    if '[SUBTITLE]' in lines[1]:
+                    if len(sub_file_lines) < 2:
+                        log.debug("File too short, ignoring subtitle file: {}".format(full_name))
+                        subtitle_files.append(file_vars)
+                        continue
+                    if '[SUBTITLE]' in sub_file_lines[1]:
                         sub_format = 'subviewer'
-                    elif re.match('^\{[0-9]+\}\{[0-9]*\}', lines[1]):
+                    elif re.match('^\{[0-9]+\}\{[0-9]*\}', sub_file_lines[1]):
                         sub_format = 'microdvd'
-                    elif re.match('^[0-9]{1,2}:[0-9]{2}:[0-9]{2}[:=,]', lines[1]):
+                    elif re.match('^[0-9]{1,2}:[0-9]{2}:[0-9]{2}[:=,]', sub_file_lines[1]):
                         sub_format = 'txt'
                     else:
                         log.debug("Unknown format, ignoring subtitle file: {}".format(full_name))
@@ -159,8 +245,6 @@ def process_subtitle_files(part):
             if sub_format is None:
                 sub_format = sub_codec
             
-            part.subtitles[lang_code][file_base_name] = Proxy.LocalFile(full_name, codec = sub_codec, format = sub_format, default = default, forced = forced)
-            
             file_vars["status"] = "success"
             file_vars["format"] = sub_format
             file_vars["codec"] = sub_codec
@@ -170,6 +254,21 @@ def process_subtitle_files(part):
             log.debug("    No subtitle files found")
         
     return subtitle_files
+
+def add_subtitle_files(part, subtitle_files):
+    """
+    Add subtitle files found by find_subtitle_files to the media item.
+
+    :param part: The part of the movie the subtitles belong to
+    :param subtitle_files: list of subtitle files returned by find_subtitle_files
+    """
+    for subtitle_file in subtitle_files:
+        if subtitle_file["status"] != "success":
+            continue
+        if subtitle_file["format"] == "vobsub":
+            part.subtitles[subtitle_file["lang_code"]][subtitle_file["base_name"]] = Proxy.LocalFile(subtitle_file["full_name"], index = subtitle_file["index"], format = "vobsub")
+        else:
+            part.subtitles[subtitle_file["lang_code"]][subtitle_file["base_name"]] = Proxy.LocalFile(subtitle_file["full_name"], codec = subtitle_file["codec"], format = subtitle_file["format"], default = subtitle_file["default"], forced = subtitle_file["forced"])
     
 def cleanup_subtitle_entries(part, subtitle_files):
     
@@ -184,7 +283,7 @@ def cleanup_subtitle_entries(part, subtitle_files):
             continue
         
         # Make sure the language key eists in the dictionary as a list
-        if not dict_code_basename.has_key(subtitle_file["lang_code"]):
+        if subtitle_file["lang_code"] not in dict_code_basename:
             dict_code_basename[subtitle_file["lang_code"]] = []
         
         # Add the basename to the list for the appropriate language code
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Benchmark reading the files of titles from a cold page cache.
+
+Generates title folders with an nfo, a poster and a fanart, and reads them
+the way update does: the nfo is parsed, then the artwork is read. Before each
+run the files are evicted from the page cache with posix_fadvise DONTNEED,
+which drops clean pages without root. Plain reads, one file after the other,
+are compared with readahead hints for all files of a title followed by
+reads with a sequential access hint.
+
+Evicting only works on disk backed file systems, tmpfs keeps the files in
+memory. Use --dir to place the files on the disk to measure.
+
+    bench_reads.py [--dir DIR] [--titles N] [--repeat N]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from bundle import load_bundle
+
+# name: size in bytes
+TITLE_FILES = (
+    ("movie.nfo", 16 * 1024),
+    ("poster.jpg", 400 * 1024),
+    ("fanart.jpg", 1536 * 1024),
+)
+
+
+def make_titles(folder, titles):
+    """
+    :param folder: the folder to create the titles in
+    :param titles: number of titles
+    :return: list of (nfo, poster, fanart) paths, one per title
+    """
+    paths = []
+    for n in range(titles):
+        title_folder = os.path.join(folder, "Title {n}".format(n=n))
+        os.mkdir(title_folder)
+        title_paths = []
+        for name, size in TITLE_FILES:
+            path = os.path.join(title_folder, name)
+            if name.endswith(".nfo"):
+                padding = "x" * (size - 64)
+                data = "<movie><title>Title {n}</title><plot>{padding}</plot></movie>"
+                data = data.format(n=n, padding=padding).encode("utf-8")
+            else:
+                data = os.urandom(size)
+            with open(path, "wb") as data_file:
+                data_file.write(data)
+                data_file.flush()
+                # dirty pages can't be evicted
+                os.fsync(data_file.fileno())
+            title_paths.append(path)
+        paths.append(tuple(title_paths))
+    return paths
+
+
+def evict(readahead, paths):
+    for title_paths in paths:
+        for path in title_paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                readahead.get_fadvise()(fd, 0, 0, readahead.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def read_plain(agent, readahead, title_paths):
+    with open(title_paths[0], "rb") as nfo_file:
+        agent.element_from_string(nfo_file.read())
+    for path in title_paths[1:]:
+        with open(path, "rb") as artwork_file:
+            artwork_file.read()
+
+
+def read_hinted(agent, readahead, title_paths):
+    readahead.prefetch(title_paths)
+    agent.element_from_string(readahead.read_file(title_paths[0]))
+    for path in title_paths[1:]:
+        readahead.read_file(path)
+
+
+def run(agent, readahead, paths, read, cold):
+    if cold:
+        evict(readahead, paths)
+    start = time.time()
+    for title_paths in paths:
+        read(agent, readahead, title_paths)
+    return time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--dir", default=None)
+    parser.add_argument("--titles", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    agent = load_bundle(prefs={"debug": False})
+    import readahead
+
+    if readahead.get_fadvise() is None:
+        sys.stderr.write("posix_fadvise is not available on this system\n")
+        return 1
+    folder = tempfile.mkdtemp(prefix="bench_reads", dir=args.dir)
+    try:
+        paths = make_titles(folder, args.titles)
+        print(
+            "{cache:>5} {mode:>7} {total:>10} {title:>10}".format(
+                cache="cache", mode="reads", total="total ms", title="ms/title"
+            )
+        )
+        for cold in (True, False):
+            for mode, read in (("plain", read_plain), ("hinted", read_hinted)):
+                best = min(
+                    run(agent, readahead, paths, read, cold) for _ in range(args.repeat)
+                )
+                print(
+                    "{cache:>5} {mode:>7} {total:>10.1f} {title:>10.3f}".format(
+                        cache="cold" if cold else "warm",
+                        mode=mode,
+                        total=best * 1000,
+                        title=best * 1000 / len(paths),
+                    )
+                )
+    finally:
+        shutil.rmtree(folder)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Benchmark the compact record encoding against plain record dicts.
+
+Reads generated nfo files into complete records, the way the record cache
+stores them, and compares plain dicts with the encoded records held by the
+cache, compressed and uncompressed: the estimated bytes per title and the
+time to look a title up and read its core fields (title, year, rating and
+summary) or all of its fields.
+
+    bench_records.py [--titles N] [--actors N] [--repeat N]
+"""
+
+import argparse
+import random
+import sys
+import timeit
+
+from bundle import load_bundle
+
+WORDS = (
+    "the a of and to in is was his her their with on for as an at by from "
+    "city night secret family war love journey house last world two return "
+    "mystery brother daughter island river stranger letter winter summer"
+).split()
+CORE_FIELDS = ("title", "year", "rating", "summary")
+
+
+def make_nfo(n, actors):
+    """
+    :param n: number of the title
+    :param actors: number of actors
+    :return: the nfo as bytes
+    """
+    text = random.Random(n)
+    plot = " ".join(text.choice(WORDS) for _ in range(140))
+    parts = [
+        "<movie><title>Title {n}</title><sorttitle>Title {n:05d}</sorttitle>"
+        "<originaltitle>Original Title {n}</originaltitle><year>{year}</year>"
+        "<rating>{rating}</rating><mpaa>PG-13</mpaa><plot>{plot}</plot>"
+        "<tagline>Tagline of title {n}</tagline><studio>Studio {studio}</studio>"
+        "<premiered>{year}-05-01</premiered><runtime>{runtime}</runtime>"
+        "<genre>Drama</genre><genre>Thriller</genre><country>France</country>"
+        "<director>Director {n}</director><credits>Writer {n}</credits>"
+        "<set>Collection {set}</set>".format(
+            n=n,
+            year=1950 + n % 70,
+            rating=n % 100 / 10.0,
+            plot=plot,
+            studio=n % 40,
+            runtime=80 + n % 60,
+            set=n % 300,
+        )
+    ]
+    for a in range(actors):
+        parts.append(
+            "<actor><name>Actor {a}</name><role>Role {a} of {n}</role>"
+            "<thumb>https://example.com/actors/{a}.jpg</thumb></actor>".format(a=a, n=n)
+        )
+    parts.append("</movie>")
+    return "".join(parts).encode("utf-8")
+
+
+def read_records(agent, titles, actors):
+    """
+    :return: list of complete records, as stored by the record cache
+    """
+    records = []
+    for n in range(titles):
+        reader = agent.NFOReader(agent.element_from_string(make_nfo(n, actors)))
+        record = reader.read_record()
+        record["duration"] = reader.read_duration()
+        record["roles"] = reader.read_roles()
+        records.append(record)
+    return records
+
+
+def lookup_plain(records, fields):
+    def lookup():
+        for record in records:
+            for field in fields or record.keys():
+                record.get(field)
+
+    return lookup
+
+
+def lookup_compact(compact, stored, fields):
+    def lookup():
+        for entry in stored:
+            record = compact.decode_record(entry)
+            for field in fields or record.keys():
+                record.get(field)
+
+    return lookup
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--titles", type=int, default=2000)
+    parser.add_argument("--actors", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    agent = load_bundle(prefs={"debug": False})
+    import compact
+    from introspection import estimate_size
+
+    records = read_records(agent, args.titles, args.actors)
+    rows = [("plain", estimate_size(records) / len(records), records, None)]
+    for compress in (False, True):
+        agent.preferences["recordcompress"] = compress
+        stored = [compact.encode_record(record) for record in records]
+        if [compact.decode_record(s).to_dict() for s in stored] != records:
+            sys.stderr.write("Decoded records differ from the records\n")
+            return 1
+        rows.append(
+            (
+                "compressed" if compress else "compact",
+                estimate_size(stored) / len(stored),
+                None,
+                stored,
+            )
+        )
+
+    print(
+        "{name:>10} {size:>10} {core:>10} {all:>10}".format(
+            name="record", size="bytes", core="core us", all="all us"
+        )
+    )
+    for name, size, plain_records, stored in rows:
+        timings = []
+        for fields in (CORE_FIELDS, None):
+            if stored is None:
+                lookup = lookup_plain(plain_records, fields)
+            else:
+                lookup = lookup_compact(compact, stored, fields)
+            best = min(timeit.repeat(lookup, number=1, repeat=args.repeat))
+            timings.append(best * 1000000 / args.titles)
+        print(
+            "{name:>10} {size:>10.0f} {core:>10.2f} {all:>10.2f}".format(
+                name=name, size=size, core=timings[0], all=timings[1]
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
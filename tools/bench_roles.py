@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Benchmark NFOReader.read_roles on large casts.
+
+Generates nfo files with 300 to 2000 actors and compares read_roles with the
+previous implementation, which ran three xpath queries per actor and looked
+duplicate roles up in a list.
+
+    bench_roles.py [--repeat N] [--actors 300,500,1000,2000]
+"""
+
+import argparse
+import sys
+import timeit
+
+from bundle import load_bundle
+
+
+def make_nfo(actors):
+    """
+    :param actors: number of actors
+    :return: the nfo as bytes
+    """
+    parts = ["<movie><title>Cast</title>"]
+    for n in range(actors):
+        parts.append(
+            "<actor><name>Actor {n}</name><role>Role {role}</role>"
+            "<order>{n}</order><thumb>https://example.com/{n}.jpg</thumb>"
+            "</actor>".format(n=n, role=n % (actors // 2 or 1))
+        )
+    parts.append("</movie>")
+    return "".join(parts).encode("utf-8")
+
+
+def read_roles_xpath(nfo_xml):
+    """
+    The previous read_roles, without its logging.
+    """
+    roles = []
+    rroles = []
+    for n, actor in enumerate(nfo_xml.xpath("actor")):
+        try:
+            name = actor.xpath("name")[0].text
+        except:
+            name = "Unknown Name " + str(n)
+        try:
+            role = actor.xpath("role")[0].text
+            if role in rroles:
+                role = role + " " + str(n)
+            rroles.append(role)
+        except:
+            role = "Unknown Role " + str(n)
+        photo = ""
+        try:
+            photo = actor.xpath("thumb")[0].text
+        except:
+            pass
+        roles.append((name, role, photo))
+    return roles
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--actors", default="300,500,1000,2000")
+    args = parser.parse_args(argv)
+
+    agent = load_bundle(prefs={"debug": False})
+    print(
+        "{actors:>7} {old:>12} {new:>12} {speedup:>8}".format(
+            actors="actors", old="xpath ms", new="read_roles ms", speedup="speedup"
+        )
+    )
+    for actors in [int(a) for a in args.actors.split(",")]:
+        nfo_xml = agent.element_from_string(make_nfo(actors))
+        reader = agent.NFOReader(nfo_xml)
+        if len(reader.read_roles()) != len(read_roles_xpath(nfo_xml)):
+            sys.stderr.write("Different number of roles for {n}\n".format(n=actors))
+            return 1
+        old = min(
+            timeit.repeat(
+                lambda: read_roles_xpath(nfo_xml), number=1, repeat=args.repeat
+            )
+        )
+        new = min(timeit.repeat(reader.read_roles, number=1, repeat=args.repeat))
+        print(
+            "{actors:>7} {old:>12.2f} {new:>12.2f} {speedup:>7.1f}x".format(
+                actors=actors, old=old * 1000, new=new * 1000, speedup=old / new
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
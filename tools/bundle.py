@@ -0,0 +1,134 @@
+# coding=utf-8
+
+"""
+Load the agent's code outside of the Plex Media Server.
+
+The plugin framework injects its API (Prefs, Dict, Log, XML, ...) as globals
+before the agent's code is imported. This module defines minimal stand-ins
+for the parts the agent uses while importing and while reading nfo files, so
+the benchmarks and tests in this folder can run the agent's modules with a
+plain Python interpreter and lxml. Metadata objects and the HTTP routes are
+not provided.
+
+    from bundle import load_bundle
+    agent = load_bundle(prefs={"debug": False})
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+
+try:
+    import __builtin__ as builtins
+except ImportError:  # Python 3
+    import builtins
+
+BUNDLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CODE_PATH = os.path.join(BUNDLE_PATH, "Contents", "Code")
+DEFAULT_PREFS = os.path.join(BUNDLE_PATH, "Contents", "DefaultPrefs.json")
+
+
+def default_preferences():
+    """
+    :return: dict of the preferences' default values
+    """
+    with open(DEFAULT_PREFS) as prefs_file:
+        defaults = json.load(prefs_file)
+    prefs = {}
+    for pref in defaults:
+        value = pref.get("default")
+        if pref["type"] == "bool":
+            value = value == "true"
+        prefs[pref["id"]] = value
+    return prefs
+
+
+class Namespace(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class PersistentDict(dict):
+    def Save(self):
+        pass
+
+
+def log_function(level):
+    def log(message, *args, **kwargs):
+        if os.environ.get("XBMCNFO_LOG"):
+            sys.stderr.write("{level} {message}\n".format(level=level, message=message))
+
+    return log
+
+
+def create_thread(function, *args, **kwargs):
+    thread = threading.Thread(target=function, args=args, kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def element_from_string(data):
+    from lxml import etree
+
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return etree.fromstring(data)
+
+
+def read_file(path, binary=True):
+    with open(path, "rb") as data_file:
+        return data_file.read()
+
+
+def decorator_factory(*args, **kwargs):
+    return lambda function: function
+
+
+def load_bundle(prefs=None, data_path=None):
+    """
+    Define the framework globals and import the agent's code.
+
+    :param prefs: (Optional) dict of preferences overriding the defaults
+    :param data_path: (Optional) the plugin's data directory, a new
+        temporary directory by default
+    :return: the agent's __init__ module
+    """
+    if "__init__" in sys.modules:
+        return sys.modules["__init__"]
+    preferences = default_preferences()
+    preferences.update(prefs or {})
+    api = {
+        "Prefs": preferences,
+        "Dict": PersistentDict(),
+        "Log": Namespace(
+            **dict(
+                (level, log_function(level))
+                for level in ("Debug", "Info", "Warn", "Error", "Critical", "Exception")
+            )
+        ),
+        "XML": Namespace(ElementFromString=element_from_string),
+        "Core": Namespace(
+            storage=Namespace(load=read_file, data_path=data_path or tempfile.mkdtemp())
+        ),
+        "Thread": Namespace(Create=create_thread),
+        "Agent": Namespace(Movies=object),
+        "Proxy": Namespace(Media=lambda data, **kwargs: data),
+        "MetadataSearchResult": dict,
+        "TrailerObject": dict,
+        "FeaturetteObject": dict,
+        "handler": decorator_factory,
+        "route": decorator_factory,
+        "JSON": Namespace(StringFromObject=json.dumps),
+        "Locale": Namespace(Language=Namespace(NoLanguage="xn")),
+        "Platform": Namespace(ServerVersion="", OS=sys.platform),
+    }
+    if sys.version_info[0] >= 3:
+        api["unicode"] = str
+    for name, value in api.items():
+        setattr(builtins, name, value)
+    sys.path.insert(0, CODE_PATH)
+    __import__("__init__")
+    return sys.modules["__init__"]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Command line client for the agent's cache control routes.
+
+    cache_control.py stats [--no-footprint]
+    cache_control.py flush [PATH]
+    cache_control.py warm PATH
+
+PATH is a library root, a title folder or a media file, as the Plex Media
+Server sees it. flush without a path flushes all caches. The server and token
+default to the PLEX_URL and PLEX_TOKEN environment variables.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+try:
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib import urlencode
+    from urllib2 import urlopen
+
+CONTROL_PREFIX = "/agents/xbmcnfo"
+
+
+def call(server, token, action, **params):
+    """
+    Call a control route.
+
+    :param server: base URL of the Plex Media Server
+    :param token: the Plex token or None
+    :param action: the route (stats, flush, warm)
+    :return: the decoded JSON response
+    """
+    params = dict((k, v) for k, v in params.items() if v is not None)
+    if token:
+        params["X-Plex-Token"] = token
+    url = "{server}{prefix}/{action}".format(
+        server=server.rstrip("/"), prefix=CONTROL_PREFIX, action=action
+    )
+    if params:
+        url += "?" + urlencode(params)
+    response = urlopen(url)
+    try:
+        return json.loads(response.read().decode("utf-8"))
+    finally:
+        response.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--server", default=os.environ.get("PLEX_URL", "http://127.0.0.1:32400")
+    )
+    parser.add_argument("--token", default=os.environ.get("PLEX_TOKEN"))
+    actions = parser.add_subparsers(dest="action")
+    stats = actions.add_parser("stats", help="report all caches")
+    stats.add_argument(
+        "--no-footprint",
+        action="store_true",
+        help="skip the memory footprint estimate",
+    )
+    flush = actions.add_parser("flush", help="flush all caches or a path")
+    flush.add_argument("path", nargs="?")
+    warm = actions.add_parser("warm", help="pre-warm the caches for a path")
+    warm.add_argument("path")
+    args = parser.parse_args(argv)
+
+    if args.action not in ("stats", "flush", "warm"):
+        parser.print_help()
+        return 2
+    try:
+        if args.action == "stats":
+            result = call(
+                args.server,
+                args.token,
+                "stats",
+                footprint="0" if args.no_footprint else "1",
+            )
+        else:
+            result = call(args.server, args.token, args.action, path=args.path)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("Request failed: {error}\n".format(error=e))
+        return 1
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+    return 1 if "error" in result else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Tests of the disc layout detection and the path plans built from it.
+
+Layouts and plans only depend on the paths, so the media files don't need to
+exist.
+
+    test_discs.py [-v]
+"""
+
+import os
+import unittest
+
+from bundle import load_bundle
+
+load_bundle(prefs={"debug": False})
+
+from discs import detect_layout  # noqa: E402
+from discs import get_disc_layout  # noqa: E402
+from resolver import build_path_plan  # noqa: E402
+
+LIBRARY = os.path.join(os.sep, "library")
+TITLE = os.path.join(LIBRARY, "Movie (2000)")
+
+
+def paths(candidates):
+    """
+    :return: the paths of the candidates, without the expensive ones
+    """
+    return [path for _, path in candidates if not callable(path)]
+
+
+class DetectLayoutTest(unittest.TestCase):
+    def test_video_ts(self):
+        folder = os.path.join(TITLE, "VIDEO_TS")
+        self.assertEqual(
+            detect_layout(folder),
+            ("video_ts", TITLE, os.path.join(folder, "VIDEO_TS.nfo")),
+        )
+
+    def test_video_ts_lower_case(self):
+        folder = os.path.join(TITLE, "video_ts")
+        self.assertEqual(detect_layout(folder).layout, "video_ts")
+        self.assertEqual(detect_layout(folder).title_root, TITLE)
+
+    def test_bdmv(self):
+        folder = os.path.join(TITLE, "BDMV")
+        self.assertEqual(
+            detect_layout(folder), ("bdmv", TITLE, os.path.join(folder, "index.nfo"))
+        )
+
+    def test_bdmv_stream(self):
+        folder = os.path.join(TITLE, "BDMV", "STREAM")
+        self.assertEqual(
+            detect_layout(folder),
+            ("bdmv", TITLE, os.path.join(TITLE, "BDMV", "index.nfo")),
+        )
+
+    def test_stream_outside_bdmv(self):
+        folder = os.path.join(TITLE, "STREAM")
+        self.assertEqual(detect_layout(folder), (None, folder, None))
+
+    def test_plain(self):
+        self.assertEqual(detect_layout(TITLE), (None, TITLE, None))
+
+    def test_trailing_separator(self):
+        folder = os.path.join(TITLE, "VIDEO_TS") + os.sep
+        self.assertEqual(detect_layout(folder).title_root, TITLE)
+
+    def test_iso(self):
+        for name in ("Movie (2000).iso", "Movie (2000).IMG"):
+            layout = get_disc_layout(os.path.join(TITLE, name))
+            self.assertEqual(layout, ("iso", TITLE, None))
+
+    def test_media_file(self):
+        layout = get_disc_layout(os.path.join(TITLE, "Movie (2000).mkv"))
+        self.assertEqual(layout, (None, TITLE, None))
+
+
+class BuildPathPlanTest(unittest.TestCase):
+    def assertTitleFolder(self, plan):
+        self.assertEqual(plan.title_root, TITLE)
+        self.assertEqual(plan.library_root, LIBRARY)
+        for kind in ("nfo", "search_nfo", "poster", "fanart"):
+            for path in paths(getattr(plan, kind)):
+                self.assertTrue(
+                    path.startswith(TITLE + os.sep), "{path} outside".format(path=path)
+                )
+
+    def assertDiscPlan(self, plan, layout, disc_nfo):
+        self.assertEqual(plan.layout, layout)
+        self.assertTitleFolder(plan)
+        self.assertEqual(plan.nfo[0], ("disc", disc_nfo))
+        self.assertEqual(plan.search_nfo[0], ("disc", disc_nfo))
+        # Kodi keeps movie.nfo next to the disc structure
+        self.assertIn(os.path.join(TITLE, "movie.nfo"), paths(plan.nfo))
+        # the disc's own file names are not looked for
+        for kind in ("nfo", "poster", "fanart"):
+            for pattern, _ in getattr(plan, kind):
+                self.assertFalse(pattern.startswith("related"), pattern)
+
+    def test_video_ts(self):
+        video_file = os.path.join(TITLE, "VIDEO_TS", "VIDEO_TS.IFO")
+        plan = build_path_plan(video_file)
+        self.assertEqual(plan.folder_path, os.path.join(TITLE, "VIDEO_TS"))
+        self.assertDiscPlan(
+            plan, "video_ts", os.path.join(TITLE, "VIDEO_TS", "VIDEO_TS.nfo")
+        )
+
+    def test_bdmv(self):
+        plan = build_path_plan(os.path.join(TITLE, "BDMV", "index.bdmv"))
+        self.assertDiscPlan(plan, "bdmv", os.path.join(TITLE, "BDMV", "index.nfo"))
+
+    def test_bdmv_stream(self):
+        video_file = os.path.join(TITLE, "BDMV", "STREAM", "00000.m2ts")
+        plan = build_path_plan(video_file)
+        self.assertEqual(plan.file_stem, "00000")
+        self.assertDiscPlan(plan, "bdmv", os.path.join(TITLE, "BDMV", "index.nfo"))
+
+    def test_iso(self):
+        plan = build_path_plan(os.path.join(TITLE, "Movie (2000).iso"))
+        self.assertEqual(plan.layout, "iso")
+        self.assertTitleFolder(plan)
+        self.assertEqual(
+            plan.nfo[0], ("related:/", os.path.join(TITLE, "Movie (2000).nfo"))
+        )
+
+    def test_plain(self):
+        plan = build_path_plan(os.path.join(TITLE, "Movie (2000)-cd1.mkv"))
+        self.assertIsNone(plan.layout)
+        self.assertEqual(plan.file_stem, "Movie (2000)-cd1")
+        self.assertEqual(plan.base_stem, "Movie (2000)")
+        self.assertTitleFolder(plan)
+        self.assertEqual(
+            plan.nfo[0], ("related:/", os.path.join(TITLE, "Movie (2000).nfo"))
+        )
+        self.assertIn(
+            os.path.join(TITLE, "Movie (2000)-poster.jpg"), paths(plan.poster)
+        )
+        # movie.nfo is only looked for when searching
+        self.assertNotIn(os.path.join(TITLE, "movie.nfo"), paths(plan.nfo))
+        self.assertIn(os.path.join(TITLE, "movie.nfo"), paths(plan.search_nfo))
+
+    def test_fallbacks_last(self):
+        for video_file in (
+            os.path.join(TITLE, "VIDEO_TS", "VIDEO_TS.IFO"),
+            os.path.join(TITLE, "Movie (2000).mkv"),
+        ):
+            plan = build_path_plan(video_file)
+            self.assertEqual(plan.nfo[-1][0], "first_nfo")
+            self.assertTrue(callable(plan.nfo[-1][1]))
+
+
+if __name__ == "__main__":
+    unittest.main()